@@ -13,7 +13,6 @@ import argparse
 import csv
 import os
 
-from geopy.distance import distance
 import pandas as pd
 
 # hacky way to make sure utils is visible
@@ -21,6 +20,9 @@ import sys
 sys.path.append(os.path.abspath(os.path.abspath(os.path.dirname(__file__)) + '/../../..'))
 
 from src.utils import config
+from src.utils.geonames import load_geonames_index
+from src.utils.geonames import lookup_populations_cached
+from src.utils.geonames import population_cache_fn
 
 
 def main():
@@ -46,6 +48,7 @@ def main():
                         help="Folder to hold survey responses + associated webrequest")
     parser.add_argument("--dist_threshold",
                         default=config.ip_dist_threshold,
+                        type=float,
                         help="Max distance in km between Geonames point and IP point for match.")
     parser.add_argument("--geonames_tsv",
                         default=config.geonames_tsv,
@@ -128,9 +131,11 @@ def group_edit_actions(user_data):
 
 def map_ip_to_population(df, geonames_tsv, dist_threshold):
     print("Loading geonames lookup")
-    geonames = get_geonames_map(geonames_tsv)
+    geonames = load_geonames_index(geonames_tsv)
     print("Calculating populations")
-    df['population'] = df.apply(lambda x: lookup_row(x, geonames, dist_threshold=dist_threshold), axis=1)
+    # IP geolocation is coarse so only distinct (country_code, city, lat, lon) keys are resolved
+    df['population'] = lookup_populations_cached(geonames, df, dist_threshold,
+                                                 population_cache_fn(geonames_tsv, geonames.build_id, dist_threshold))
     print("Success rate:", (df['population'] >= 1).sum() / df['population'].count())
     print("Breakdown of matches:", df['population'].apply(lambda x: 1 if x > 0 else x).value_counts(dropna=False))
     try:
@@ -140,138 +145,5 @@ def map_ip_to_population(df, geonames_tsv, dist_threshold):
     except Exception:
         print("Failed to dump IP->population data.")
 
-def calc_dist(pt1, pt2):
-    return distance(pt1, pt2).kilometers
-
-def get_geonames_map(allcountries):
-    geonames_header = ['geonameid', 'name', 'asciiname', 'alternatenames',
-                       'latitude', 'longitude', 'feature class', 'feature code',
-                       'country code', 'cc2', 'admin1 code', 'admin2 code', 'admin3 code', 'admin4 code',
-                       'population', 'elevation', 'dem', 'timezone', 'modification date']
-    country_idx = geonames_header.index('country code')
-    pop_idx = geonames_header.index('population')
-    lat_idx = geonames_header.index('latitude')
-    lon_idx = geonames_header.index('longitude')
-    name_idx = geonames_header.index('name')
-    altname_idx = geonames_header.index('alternatenames')
-    feature_idx = geonames_header.index('feature class')
-
-    lookup = {}
-    num_countries = 0
-    num_places = 0
-    num_pops = 0
-    nonzero_pops = 0
-    duplicates = 0
-    with open(allcountries, 'r') as fin:
-        tsvreader = csv.reader(fin, delimiter='\t')
-        for line in tsvreader:
-            feature = line[feature_idx]
-            try:
-                population = int(line[pop_idx])
-            except ValueError:
-                population = -1
-            if (feature == 'A' and population >= 0) or feature == 'P':
-                pt = (float(line[lat_idx]), float(line[lon_idx]))
-                names = [line[name_idx]]
-                if line[altname_idx]:
-                    names.extend(line[altname_idx].split(','))
-                country = line[country_idx]
-                if country not in lookup:
-                    num_countries += 1
-                    lookup[country] = {}
-                for n in names:
-                    if n in lookup[country]:
-                        if pt in lookup[country][n]:
-                            existing_pop = lookup[country][n][pt]
-                            if not population:
-                                continue
-                            elif existing_pop == population:
-                                continue
-                            elif not existing_pop:
-                                lookup[country][n][pt] = population
-                                num_pops += 1
-                            else:
-                                duplicates += 1
-                        else:
-                            lookup[country][n][pt] = population
-                            num_places += 1
-                            if num_places % 500000 == 0:
-                                print(num_places, "added.")
-                            if population >= 0:
-                                num_pops += 1
-                                if population == 0:
-                                    nonzero_pops += 1
-                    else:
-                        lookup[country][n] = {pt:population}
-                        num_places += 1
-                        if num_places % 500000 == 0:
-                            print(num_places, "added.")
-                        if population >= 0:
-                            num_pops += 1
-                            if population == 0:
-                                nonzero_pops += 1
-    print("{0} countries. {1} places. {2} places w/ population. {3} w/ pop 0. {4} duplicates".format(
-        num_countries, num_places, num_pops, nonzero_pops, duplicates))
-    # add location-based lookup index for places w/ unknown cities but that still have points
-    locs_to_add = {}
-    for cc in lookup:
-        for n in lookup[cc]:
-            for loc in lookup[cc][n]:
-                simple_loc = (int(loc[0]), int(loc[1]))
-                if simple_loc not in locs_to_add:
-                    locs_to_add[simple_loc] = set()
-                locs_to_add[simple_loc].add((cc, n))
-    for l in locs_to_add:
-        lookup[l] = locs_to_add[l]
-    return lookup
-
-def lookup_row(x, geonames, dist_threshold):
-    country = x['country_code']
-    city = x['city']
-    pt = (float(x['lat']), float(x['lon']))
-    # no city info, use lat-lon as backup
-    if city.lower() == "unknown":
-        return lookup_pt(pt, geonames, dist_threshold)
-    # use city to geocode and then lat-lon to filter
-    else:
-        try:
-            candidates = geonames[country][city]
-            within_thres = []
-            # find all potential place matches
-            for cpt, cpop in candidates.items():
-                if calc_dist(pt, cpt) < dist_threshold:
-                    within_thres.append(cpop)
-            # return potential match with highest population (arbitrary choice but empirically seems to matter little)
-            if within_thres:
-                # Success: found a matching place w/i distance threshold
-                # Possibilities:
-                # >0 == have a real population
-                # 0 if geonames listed that
-                # -1 population if geonames didn't provide a number
-                return max(within_thres)
-            else:
-                # found a matching name but was not close enough
-                backup = lookup_pt(pt, geonames, dist_threshold)
-                if backup > 0:
-                    return backup
-                else:
-                    return -2
-        except KeyError:
-            # did not find a matching name
-            return lookup_pt(pt, geonames, dist_threshold)
-
-def lookup_pt(pt, geonames, dist_threshold):
-    simple_pt = (int(pt[0]), int(pt[1]))
-    closest_with_pop = float('inf')
-    pop = -3
-    for cc, name in geonames.get(simple_pt, []):
-        for cpt, cpop in geonames[cc][name]:
-            if cpop > 0:
-                cand_dist = calc_dist(pt, cpt)
-                if cand_dist < dist_threshold and cand_dist < closest_with_pop:
-                    closest_with_pop = cand_dist
-                    pop = cpop
-    return pop
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,16 +1,19 @@
 import argparse
-import datetime
 import os
 import pickle
 # hacky way to make sure utils is visible
 import sys
 
+import numpy as np
 import pandas as pd
 
 sys.path.append(os.path.abspath(os.path.abspath(os.path.dirname(__file__)) + '/../../..'))
 
 from src.utils import config
-from src.utils import read_redirects
+from src.utils import GeoDecoder
+from src.utils import load_redirect_index
+from src.utils import TraceTable
+from src.utils import TraceTableBuilder
 
 
 def main():
@@ -62,15 +65,22 @@ def main():
         print("**************")
         with open(os.path.join(args.in_dir_traces, "sample_{0}.csv".format(lang)), "r") as f:
             lines = []
+            builder = TraceTableBuilder()
+            geo_decoder = GeoDecoder()
             assert next(f).strip().split('\t') == ['userhash', 'geocoded_data', 'has_account', 'attempted_edit', 'requests']
             for l_count, line in enumerate(f, start=1):
-                l = parse_row(line)
+                l = parse_row(line, builder, geo_decoder)
                 if l is not None:
                     lines.append(l)
                 if l_count % 10000 == 0:
                     print("processing line...", l_count)
             print("traces processed: ", l_count)
+            print("distinct geocoded_data records: ", len(geo_decoder))
 
+        traces = builder.build()
+        print("requests with malformed timestamps (NaT): ", traces.num_invalid_ts())
+        for l in lines:
+            l['requests'] = traces.trace(l['requests'])
         df_traces = pd.DataFrame(lines)
         print("traces kept", len(df_traces))
         df_traces.drop_duplicates(subset=["userhash"], inplace=True)
@@ -89,8 +99,13 @@ def main():
                              right_on=["userhash"], how="inner")
         print("Users in merged dataframe of survey responses and webrequest traces:", len(df_merged))
 
-        df_merged['requests'] = df_merged['requests'].apply(parse_requests_ts_and_redirects,
-                                                            d=read_redirects(lang, args.redirect_dir))
+        # compact the trace table to the merged users before resolving redirects / pickling it
+        traces = TraceTable.from_traces(df_merged['requests'])
+        resolve_redirects(traces, load_redirect_index(lang, args.redirect_dir))
+        df_merged['requests'] = [t if len(t) else None for t in traces.traces()]
+        # parse all survey initialization timestamps at once
+        df_merged['quicksurvey_dt'] = pd.to_datetime(df_merged['dt_qsinitialization'].astype(str),
+                                                     format='%Y-%m-%dT%H:%M:%S').values.astype('datetime64[s]')
         df_merged['survey_request'] = df_merged.apply(extract_survey_request, lang=lang, axis=1)
         df_merged['wiki'] = df_merged.apply(lambda x: x['survey_request'].get('uri_host', lang), axis=1)
         df_merged['survey_dt_utc'] = df_merged['survey_request'].apply(lambda x: x.get('ts', None))
@@ -100,14 +115,14 @@ def main():
         df_merged['page_title'] = df_merged['survey_request'].apply(lambda x: x['title'])
         df_merged['page_id'] = df_merged['survey_request'].apply(lambda x: x['page_id'])
         df_merged = df_merged.reset_index(drop=True)
-        unmatched_countries = df_merged[
-            df_merged['geocoded_data'].apply(lambda x: x['country']) != df_merged['country']]
+        df_merged['requests'] = TraceTable.from_traces(df_merged['requests']).traces()
+        df_geo = geo_decoder.to_frame(geo_cols)
+        unmatched_countries = df_merged[df_merged['geo_id'].map(df_geo['country']) != df_merged['country']]
         if len(unmatched_countries) > 0:
             print("Unmatched countries:", unmatched_countries)
 
         print("Anonymizing survey...")
-        for geo_col in geo_cols:
-            df_merged[geo_col] = df_merged['geocoded_data'].apply(lambda x: x.get(geo_col, None))
+        df_merged = df_merged.drop(columns=geo_cols, errors='ignore').join(df_geo, on='geo_id')
         df_merged = df_merged[columns_to_keep]
         pickle.dump(df_merged,
                     open(os.path.join(args.out_dir, "joined_responses_and_traces_anon_{0}.p".format(lang)), "wb"))
@@ -116,69 +131,48 @@ def main():
         print("finished")
 
 
-def parse_row(line):
+def parse_row(line, builder, geo_decoder):
+    """Parse one trace line; the requests are appended to `builder` and replaced by the user's index in it."""
     row = line.strip().split('\t')
     if len(row) != 5:
         return None
 
+    geo_id = geo_decoder.decode(row[1])
     d = {'userhash': row[0],
-         'geocoded_data': eval(row[1]),
+         'geo_id': geo_id,
+         'geocoded_data': geo_decoder.records[geo_id],
          'has_account': bool(int(row[2])),
          'attempted_edit': bool(int(row[3])),
-         'requests': parse_requests(row[4])
+         'requests': builder.add(row[4])
          }
     if d['requests'] is None:
         return None
     return d
 
 
-def parse_requests(requests):
-    ret = []
-    for r in requests.split(config.request_delim):
-        t = r.split('|')
-        if (len(t) % 2) != 0:  # should be list of (name, value) pairs and contain at least userhash,ts,title
-            continue
-        data_dict = {t[i]: t[i + 1] for i in range(0, len(t), 2)}
-        ret.append(data_dict)
-    try:
-        ret.sort(key=lambda x: x['ts'])  # sort by time
-    except:
-        return None
-
-    return ret
-
-
 def extract_survey_request(l, lang):
-    quicksurvey_dt = datetime.datetime.strptime(str(l.dt_qsinitialization), '%Y-%m-%dT%H:%M:%S')
-    timestamp_only = False
-    if pd.isnull(l.page_id) and pd.isnull(l.page_title):
-        timestamp_only = True
-    else:
+    quicksurvey_dt = np.datetime64(l.quicksurvey_dt, 's')
+    if l.requests is None:
+        return {}
+    trace = l.requests
+    # same lang as survey was deployed and viewed before the survey was initialized
+    candidates = trace.equals('lang', lang) & (trace.column('ts') <= quicksurvey_dt)
+    if not (pd.isnull(l.page_id) and pd.isnull(l.page_title)):
         page_title = str(l.page_title)
         page_id = int(l.page_id)
-    if l.requests is not None:
-        for req in reversed(l.requests):
-            # same lang as survey was deployed
-            if req['lang'] == lang:
-                # same page title (no redirects) or same page id / lang (reflects redirects)
-                pageview_ts = req["ts"]
-                if timestamp_only or ((req["title"] == page_title) or (req["uri_path"] == ("/wiki/" + page_title)) or (
-                        int(req['page_id']) == page_id)):
-                    if pageview_ts <= quicksurvey_dt:
-                        return req
+        # same page title (no redirects) or same page id / lang (reflects redirects)
+        candidates &= (trace.equals('title', page_title) | trace.equals('uri_path', "/wiki/" + page_title) |
+                       (trace.column('page_id') == page_id))
+    matches = np.flatnonzero(candidates)
+    if len(matches):
+        return trace[matches[-1]]
 #    print("Not matched: {0}; {1} requests.".format(l.page_title, len(l.requests)))
     return {}
 
 
-def parse_requests_ts_and_redirects(requests, d={}):
-    if len(requests) == 0:
-        return None
-    for i, r in enumerate(requests):
-        r['userhash'] = i
-        r['ts'] = datetime.datetime.strptime(r['ts'], '%Y-%m-%d %H:%M:%S')
-        if r['title'] in d:
-            r['title'] = d[r['title']]
-    return requests
+def resolve_redirects(traces, d={}):
+    """Map redirect titles in the trace table to their targets."""
+    traces.map_strings('title', d)
 
 
 if __name__ == "__main__":
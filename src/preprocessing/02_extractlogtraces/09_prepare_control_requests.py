@@ -1,8 +1,9 @@
 import argparse
-import datetime
+from multiprocessing import Pool
 import os
 import random
 
+import numpy as np
 import pandas as pd
 
 # hacky way to make sure utils is visible
@@ -10,8 +11,11 @@ import sys
 sys.path.append(os.path.abspath(os.path.abspath(os.path.dirname(__file__)) + '/../../..'))
 
 from src.utils import config
-from src.utils import read_redirects
+from src.utils import GeoDecoder
+from src.utils import load_redirect_index
 from src.utils import main_page_titles
+from src.utils import TraceTable
+from src.utils import TraceTableBuilder
 
 def main():
     parser = argparse.ArgumentParser()
@@ -28,8 +32,24 @@ def main():
     parser.add_argument("--out_dir",
                         default=config.smpl_anon_folder,
                         help="Folder for output joined responses/traces.")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=int,
+                        help="Number of processes for parsing the traces file.")
+    parser.add_argument("--chunk_mb",
+                        default=64,
+                        type=int,
+                        help="Size (MB) of the byte ranges the traces file is split into.")
+    parser.add_argument("--seed",
+                        default=None,
+                        type=int,
+                        help="Seed for selecting the 'survey' request. Results do not depend on --workers.")
     args = parser.parse_args()
 
+    if args.seed is None:
+        args.seed = random.randrange(2 ** 32)
+    print("Seed for survey request selection: {0}".format(args.seed))
+
     if not os.path.isdir(args.out_dir):
         print("Creating directory: {0}".format(os.path.abspath(args.out_dir)))
         os.mkdir(args.out_dir)
@@ -43,35 +63,63 @@ def main():
         success_count = 0
         none_count = 0
 
-        redirects = read_redirects(lang, args.redirect_dir)
+        redirects = load_redirect_index(lang, args.redirect_dir)
+
+        traces_fn = os.path.join(args.in_dir_traces, "sample_{0}.csv".format(lang))
+        chunks = find_chunks(traces_fn, args.chunk_mb * 1024 * 1024)
+        print("{0} chunks; {1} workers".format(len(chunks), args.workers))
+        if args.workers > 1:
+            with Pool(args.workers) as pool:
+                results = pool.starmap(parse_chunk, [(traces_fn, start, end) for start, end in chunks])
+        else:
+            results = [parse_chunk(traces_fn, start, end) for start, end in chunks]
 
+        # merge per-chunk results: shift user indices into the concatenated table and re-intern geo records
         instances = []
+        user_rngs = []
+        geo_decoder = GeoDecoder()
+        num_users = 0
+        for chunk_idx, (chunk_instances, chunk_traces, geo_records, chunk_errors, chunk_nones) in enumerate(results):
+            geo_ids = geo_decoder.merge(geo_records)
+            for row in chunk_instances:
+                row['requests'] += num_users
+                row['geo_id'] = geo_ids[row['geo_id']]
+                row['geocoded_data'] = geo_decoder.records[row['geo_id']]
+                instances.append(row)
+            num_users += len(chunk_traces)
+            # one generator per chunk so the selected request does not depend on the number of workers
+            user_rngs.extend([random.Random("{0}:{1}".format(args.seed, chunk_idx))] * len(chunk_traces))
+            error_count += chunk_errors
+            none_count += chunk_nones
+        traces = TraceTable.concatenate([r[1] for r in results])
+        print("users parsed: ", len(traces))
+        print("requests with malformed timestamps (NaT): ", traces.num_invalid_ts())
+        print("distinct geocoded_data records: ", len(geo_decoder))
+        del results
+
+        survey_requests = select_survey_requests(traces, redirects, lang, user_rngs)
         with open(os.path.join(args.in_dir_traces, "parsed_{0}.csv".format(lang)), "w") as out:
-            with open(os.path.join(args.in_dir_traces, "sample_{0}.csv".format(lang)), 'r') as f:
-                for i, row in enumerate(f):
-                    if i > 0:
-                        try:
-                            row = parse_row(row, redirects, lang)
-                            if row is not None:
-                                instances.append(row)
-                                out.write(str(row) + "\n")
-                                success_count += 1
-                            else:
-                                none_count += 1
-                        except Exception as e:
-                            print(e)
-                            error_count += 1
-                        if i % 10000 == 0:
-                            print("processing line...", i)
-                print("line count: ", i)
-
-        df = pd.DataFrame(instances, columns=["userhash", "geocoded_data", "survey_request", "requests"])
+            kept = []
+            for row in instances:
+                survey_request = survey_requests[row['requests']]
+                if survey_request is None:
+                    none_count += 1
+                    continue
+                row['requests'] = traces.trace(row['requests'])
+                row['survey_request'] = survey_request
+                kept.append(row)
+                out.write(str(row) + "\n")
+                success_count += 1
+            instances = kept
+
+        df = pd.DataFrame(instances, columns=["userhash", "geo_id", "geocoded_data", "survey_request", "requests"])
         print("size df: ", len(df))
         df['survey_dt_utc'] = df['survey_request'].apply(lambda x: x['ts'])
         df['survey_title'] = df['survey_request'].apply(lambda x: x['title'])
 
         df.dropna(inplace=True, subset=['requests'])
         df = df.reset_index(drop=True)
+        df['requests'] = TraceTable.from_traces(df['requests']).traces()
         print("size after dropping users without request: ", len(df))
 
         print("# errors: ", error_count)
@@ -81,61 +129,103 @@ def main():
         print("Anonymizing survey...")
 
         geo_cols = ["continent", "country", "country_code", "timezone"]
-        for geo_col in geo_cols:
-            df[geo_col] = df['geocoded_data'].apply(lambda x: x.get(geo_col, None))
+        df = df.join(geo_decoder.to_frame(geo_cols), on='geo_id')
         df.to_pickle(os.path.join(args.out_dir, "sample_df_{0}.p".format(lang)))
         print("finished")
 
 
 
-def parse_row(line, redirects, lang):
+def find_chunks(fn, chunk_size):
+    """Split the traces file (minus header) into newline-aligned byte ranges of roughly chunk_size bytes."""
+    chunks = []
+    file_size = os.path.getsize(fn)
+    with open(fn, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        while start < file_size:
+            f.seek(min(start + chunk_size, file_size))
+            f.readline()
+            end = f.tell()
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def parse_chunk(fn, start, end):
+    """Parse the trace lines in byte range [start, end) of fn.
+
+    Returns the parsed rows (user / geo indices local to the chunk), their TraceTable,
+    the distinct geo records, and the error and none counts.
+    """
+    error_count = 0
+    none_count = 0
+    instances = []
+    builder = TraceTableBuilder()
+    geo_decoder = GeoDecoder()
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            try:
+                row = parse_row(line.decode('utf-8'), builder, geo_decoder)
+                if row is not None:
+                    instances.append(row)
+                else:
+                    none_count += 1
+            except Exception as e:
+                print(e)
+                error_count += 1
+    print("processed bytes {0}-{1}: {2} users".format(start, end, len(instances)))
+    return instances, builder.build(), geo_decoder.records, error_count, none_count
+
+
+def parse_row(line, builder, geo_decoder):
+    """Parse one trace line; the requests are appended to `builder` and replaced by the user's index in it."""
     row = line.strip().split('\t')
     if len(row) != 3:
         return None
     
+    geo_id = geo_decoder.decode(row[1])
     d = {'userhash': row[0],
-         'geocoded_data' : eval(row[1]),
-         'requests' : parse_requests(row[2])
+         'geo_id': geo_id,
+         'geocoded_data' : geo_decoder.records[geo_id],
+         'requests' : builder.add(row[2])
         }
     if d['requests'] is None:
         return None
-
-    # select "survey" request
-    title_check = ["hyphen-minus"]
-    out = []
-    for i, r in enumerate(d["requests"]):
-        r["userhash"] = i
-        if "title" in r and r['lang'] == lang:
-            if r['title'] in redirects:
-                r['title'] = redirects[r['title']]
-            if r['title'] == main_page_titles.get(lang, None):
-                continue
-            if not any(x in r["title"].lower() for x in title_check):
-                r['ts'] = datetime.datetime.strptime(r['ts'], '%Y-%m-%d %H:%M:%S')
-                out.append(r)
-    if len(out) > 0:
-        d["survey_request"] = random.choice(out)
-        return d
-    else:
-        return None
+    return d
 
 
+def select_survey_requests(traces, redirects, lang, user_rngs):
+    """Resolve redirects and randomly select a "survey" request for each user (None if no valid request).
 
-def parse_requests(requests):
-    ret = []
-    for r in requests.split(config.request_delim):
-        t = r.split('|')
-        if (len(t) % 2) != 0: # should be list of (name, value) pairs and contain at least userhash,ts,title
-            continue
-        data_dict = {t[i]:t[i+1] for i in range(0, len(t), 2)}
-        ret.append(data_dict)
-    try:
-        ret.sort(key = lambda x: x['ts']) # sort by time
-    except:
-        return None
-    
-    return ret
+    user_rngs holds the random.Random used for each user.
+    """
+    # redirects are only resolved for requests to the language being processed
+    lang_mask = traces.equals('lang', lang)
+    traces.map_strings('title', redirects, rows_mask=lang_mask)
 
+    # select "survey" request
+    title_check = ["hyphen-minus"]
+    titles = traces.vocabs['title']
+    valid_title = np.array([t != main_page_titles.get(lang, None) and not any(x in t.lower() for x in title_check)
+                            for t in titles] + [False], dtype=bool)
+    # MISSING (-1) title codes index the trailing False
+    candidates = lang_mask & valid_title[traces.columns['title']]
+
+    survey_requests = []
+    offsets = traces.offsets
+    for u in range(len(traces)):
+        out = offsets[u] + np.flatnonzero(candidates[offsets[u]:offsets[u + 1]])
+        if len(out) > 0:
+            survey_requests.append(traces.record(user_rngs[u].choice(out)))
+        else:
+            survey_requests.append(None)
+    return survey_requests
 
 
 def extract_survey_request (l):
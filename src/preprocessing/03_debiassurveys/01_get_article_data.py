@@ -2,9 +2,12 @@ import argparse
 import bz2
 from collections import namedtuple
 import csv
+import itertools
+from multiprocessing import Pool
 import os
 import pickle
 import sys
+from xml.etree import ElementTree
 
 import gensim
 from mw.xml_dump import Iterator
@@ -15,9 +18,21 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 
 # hacky way to make sure utils is visible
 sys.path.append(os.path.abspath(os.path.abspath(os.path.dirname(__file__)) + '/../../..'))
+from src.utils import article_store_dir
+from src.utils import check_article_store
 from src.utils import config
 from src.utils import download_dump_file
 from src.utils import exec_hive_stat2
+from src.utils import iter_sql_rows
+from src.utils import sql_columns
+from src.utils import save_article_store
+from src.utils.corpus import StreamingTfidfCorpus
+from src.utils.linkgraph import build_graph_features
+from src.utils.linkgraph import build_title_nodes
+from src.utils.pageviews import aggregate_pageviews
+from src.utils.pageviews import user_pageview_files
+
+Page = namedtuple('Page', ['title', 'length'])
 
 def main():
     parser = argparse.ArgumentParser()
@@ -49,6 +64,14 @@ def main():
     parser.add_argument("--pageviews_dir",
                         default=config.pageviews_folder,
                         help="Folder containing pageview data for articles.")
+    parser.add_argument("--pageview_source",
+                        default="hive",
+                        choices=["hive", "dumps"],
+                        help="Get pageviews via Hive or by aggregating local pageview dumps.")
+    parser.add_argument("--pageview_dumps_dir",
+                        default=config.pageview_dumps_folder,
+                        help="Folder containing the daily user-agent pageview complete dumps "
+                             "(pageviews-YYYYMMDD-user.bz2).")
     parser.add_argument("--page_txt_dir",
                         default=config.page_txt_folder,
                         help="Folder containing bz2 dump of article text.")
@@ -61,6 +84,16 @@ def main():
     parser.add_argument("--article_dir",
                         default=config.article_folder,
                         help="Folder with article-specific features")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=int,
+                        help="Number of processes for extracting article text from the (multistream) dump.")
+    parser.add_argument("--lda_update",
+                        action="store_true",
+                        help="Reuse the saved LDA model and only infer topics for new pages in titles_<lang>.p.")
+    parser.add_argument("--streaming_lda",
+                        action="store_true",
+                        help="Build the LDA corpus on disk and train a multicore online LDA (bounded memory).")
     args = parser.parse_args()
 
     for lang in args.languages:
@@ -68,6 +101,12 @@ def main():
 
         # build dictionaries w/ all page IDs in data and all page lengths (not including redirects) in <lang>wiki
         id2title = get_pageids(lang, args)
+        lda_fn = os.path.join(args.page_features_dir, "{0}_lda_features.tsv".format(lang))
+        props_fn = page_props_fn(lang, args.sql_folder)
+        if not os.path.exists(props_fn) and not os.path.exists(lda_fn) and not get_sql_dump(lang, args.sql_date, args.sql_folder):
+            # both need the XML dump: collect page properties while building the topic model (one pass)
+            get_lda_features(args.page_features_dir, lang, args.sql_date, args.workers, args.streaming_lda,
+                             page_props_fn=props_fn)
         id2length = get_id2properties(lang, args.sql_date, args.sql_folder)
 
         # This just checks if we can find a length for each ID
@@ -85,7 +124,11 @@ def main():
         # create the dataframe for the pageviews
         pview_fn = os.path.join(args.pageviews_dir, "{0}_pageviews.csv".format(lang))
         if not os.path.exists(pview_fn):
-            get_pageview_data(lang, args.pageviews_dir)
+            if args.pageview_source == "dumps":
+                get_pageview_dump_data(lang, args.sql_date, args.sql_folder, args.pageview_dumps_dir, pview_fn,
+                                       args.workers)
+            else:
+                get_pageview_data(lang, args.pageviews_dir)
         df_pviews = pd.read_csv(pview_fn, delimiter="\t")
         df_pviews = df_pviews[~df_pviews['page_id'].isnull()]
         df_pviews['page_id'] = df_pviews['page_id'].astype(int)
@@ -99,19 +142,29 @@ def main():
         print("Null lengths:", len(df_pdata_pviews[df_pdata_pviews["page_length"] == -1]))
 
         # Gather LDA features
-        df_lda = get_lda_features(args.page_features_dir, lang, args.sql_date)
+        df_lda = get_lda_features(args.page_features_dir, lang, args.sql_date, args.workers, args.streaming_lda,
+                                  page_ids=[pid for pid in id2title if type(pid) == int] if args.lda_update else None)
 
         # merge the lda features
         df_with_topics = pd.merge(left=df_pdata_pviews, right=df_lda, how="left", left_index=True, right_index=True)
         print("# articles with topics:", df_with_topics['main_topic'].count())
 
         # Join Network features
-        df_graph = pd.read_csv(os.path.join(args.article_graph_dir, "{0}_graph_features.csv".format(lang)), header=None,
+        graph_fn = os.path.join(args.article_graph_dir, "{0}_graph_features.csv".format(lang))
+        if not os.path.exists(graph_fn):
+            get_graph_features(lang, args.sql_date, args.sql_folder, graph_fn)
+        df_graph = pd.read_csv(graph_fn, header=None,
                                names=["id", "pagerank", "indegree", "outdegree"])
         df_graph.set_index('id', inplace=True)
         df_all = pd.merge(left=df_with_topics, right=df_graph, how="left", left_index=True, right_index=True)
-        with open(os.path.join(args.article_dir, "article_features_{0}.p".format(lang)), 'wb') as fout:
-            pickle.dump(df_all, fout)
+        topic_columns = ['topic{0}'.format(i) for i in range(config.num_lda_topics)]
+        store_dir = article_store_dir(args.article_dir, lang)
+        save_article_store(store_dir,
+                           titles=df_all['page_title'],
+                           page_ids=df_all.index,
+                           columns=df_all,
+                           topics=df_all[topic_columns].values)
+        check_article_store(store_dir, df_all, 'page_title', topic_columns)
 
         for c in df_all.columns:
             print(df_all[c].describe())
@@ -137,11 +190,19 @@ def get_pageids(lang, args):
 
     return pids_to_titles
 
-def get_lda_features(page_features_dir, lang, date):
+def get_lda_features(page_features_dir, lang, date, workers=1, streaming=False, page_ids=None, page_props_fn=None):
+    """Topic features per page id. If `page_ids` are given and a model was saved before, only topics for
+    page ids missing from the features TSV are inferred (the model is not retrained). If `page_props_fn`
+    is given, page properties are collected while the topic model is built (single pass over the dump)."""
     fn = os.path.join(page_features_dir, "{0}_lda_features.tsv".format(lang))
-    if not os.path.exists(fn):
+    article_lda = ArticleLDA(page_features_dir, lang, date, workers=workers, streaming=streaming,
+                             page_props_fn=page_props_fn)
+    if page_ids is not None and article_lda.has_model():
+        print("Updating LDA features for:", lang)
+        article_lda.update_topic_features(page_ids)
+    elif not os.path.exists(fn):
         print("Building LDA features for:", lang)
-        ArticleLDA(page_features_dir, lang, date).build_topic_model()
+        article_lda.build_topic_model()
     colnames = ['lda_pid'] + ['topic{0}'.format(i) for i in range(config.num_lda_topics)]
     datatypes = {'lda_pid':np.int32}
     datatypes.update({'topic{0}'.format(i):np.float32 for i in range(config.num_lda_topics)})
@@ -154,14 +215,23 @@ def get_lda_features(page_features_dir, lang, date):
 
 class ArticleLDA:
 
-    def __init__(self, output_features_dir, lang, date, id2title=None):
+    def __init__(self, output_features_dir, lang, date, id2title=None, workers=1, streaming=False, page_props_fn=None):
         self.output_features_tsv = os.path.join(output_features_dir, "{0}_lda_features.tsv".format(lang))
         self.output_lda = os.path.join(output_features_dir, '{0}.lda'.format(lang))
         self.output_overview = os.path.join(output_features_dir, '{0}_overview.tsv'.format(lang))
+        self.output_corpus = os.path.join(output_features_dir, '{0}_corpus'.format(lang))
+        self.output_vectorizer = os.path.join(output_features_dir, '{0}_tfidf.p'.format(lang))
+        self.output_skipped = os.path.join(output_features_dir, '{0}_lda_skipped.txt'.format(lang))
         self.lang = lang
         self.date = date
         self.article_dump = build_local_currentpage_dump_fn(self.lang, self.date)
+        self.multistream_dump = build_local_multistream_dump_fn(self.lang, self.date)
+        self.multistream_index = build_local_multistream_index_fn(self.lang, self.date)
+        self.workers = workers
+        self.streaming = streaming
         self.page_ids = []
+        self.restrict_ids = None  # if set, only these page ids are parsed (all others are skipped)
+        self.page_props_fn = page_props_fn  # if set, page properties are written here from the same dump pass
         self.page_count = 0
         self.skipped = 0
         self.id2title = id2title
@@ -169,48 +239,106 @@ class ArticleLDA:
 
     def id2text_iterator(self):
         capture_ids = not self.page_ids
+        has_multistream = os.path.exists(self.multistream_dump) and os.path.exists(self.multistream_index)
+        # restricted to a few pages, seeking to their streams beats reading the whole dump even on one core
+        if has_multistream and (self.workers > 1 or self.restrict_ids is not None):
+            dump_fn = self.multistream_dump
+            pages = self.parallel_page_iterator()
+        else:
+            dump_fn = self.article_dump
+            if self.restrict_ids is not None:
+                print("WARNING: multistream dump / index not found ({0}, {1}); scanning all of {2} "
+                      "for {3} pages.".format(self.multistream_dump, self.multistream_index, self.article_dump,
+                                              len(self.restrict_ids)))
+            pages = self.page_iterator()
+        # every page of the single dump pass is fanned out to the property collector (optional),
+        # the page id capture and the plaintext consumer (e.g., the vectorizer)
+        collect_props = self.page_props_fn is not None
+        id2props = {}
+        for page_id, title, length, plaintext in pages:
+            if plaintext is None:
+                self.skipped += 1
+                continue
+            if collect_props:
+                id2props[page_id] = Page(title, length)
+            self.page_count += 1
+            if capture_ids:
+                self.page_ids.append(page_id)
+            yield plaintext
+        if capture_ids:
+            print("{0}: {1} pages yielded. {2} skipped.".format(dump_fn, self.page_count, self.skipped))
+        if collect_props:
+            write_page_props(self.page_props_fn, id2props)
+
+    def page_iterator(self):
+        """(page id, title, text length, plaintext) for every page in the dump.
+
+        Title, length and plaintext are None if the page is skipped (not an article or not in restrict_ids).
+        """
         with bz2.BZ2File(self.article_dump, 'r') as fin:
             d = Iterator.from_file(fin)
             for page in d:
-                if not page.redirect and page.namespace == 0:
+                if self.restrict_ids is not None and page.id not in self.restrict_ids:
+                    yield page.id, None, None, None
+                elif not page.redirect and page.namespace == 0:
                     wikitext = next(page).text
-                    plaintext = mwparserfromhell.parse(wikitext).strip_code()
-                    self.page_count += 1
-                    if capture_ids:
-                        self.page_ids.append(page.id)
-                    yield plaintext
+                    yield page.id, page.title, len(wikitext), mwparserfromhell.parse(wikitext).strip_code()
                 else:
-                    self.skipped += 1
-        if capture_ids:
-            print("{0}: {1} pages yielded. {2} skipped.".format(self.article_dump, self.page_count, self.skipped))
+                    yield page.id, None, None, None
+
+    def parallel_page_iterator(self, streams_per_task=20):
+        """Same as page_iterator but decompresses and parses the bz2 streams of the multistream dump
+        in a process pool (in this process if workers is 1). Results are collected in order, so pages
+        are still yielded in dump order. With restrict_ids, only the streams holding one of those pages
+        are read."""
+        streams = get_multistream_ranges(self.multistream_dump, self.multistream_index, self.restrict_ids)
+        tasks = [(self.multistream_dump, streams[i:i + streams_per_task])
+                 for i in range(0, len(streams), streams_per_task)]
+        print("{0}: {1} streams; {2} workers".format(self.multistream_dump, len(streams), self.workers))
+        if self.workers == 1:
+            for task in tasks:
+                for page in extract_stream_texts(task):
+                    yield page
+            return
+        with Pool(self.workers) as pool:
+            for pages in pool.imap(extract_stream_texts, tasks):
+                for page in pages:
+                    yield page
 
     def build_topic_model(self):
-        tfidf_model = TfidfVectorizer(max_df=config.lda_max_df,
-                                      min_df=config.lda_min_df,
-                                      max_features=config.lda_max_features)
-        corpus = tfidf_model.fit_transform(self.id2text_iterator())
-        corpus = gensim.matutils.Sparse2Corpus(corpus, documents_columns=False)
-        id2word = {wid:word for word,wid in tfidf_model.vocabulary_.items()}
-        lda = gensim.models.ldamodel.LdaModel(corpus=corpus,
-                                              id2word=id2word,
-                                              num_topics=config.num_lda_topics,
-                                              update_every=1,
-                                              passes=1)
-
-        # save LDA model features
+        if self.streaming:
+            # tf-idf counts are written to disk in chunks and streamed to a multicore online LDA
+            corpus = StreamingTfidfCorpus(self.output_corpus,
+                                          max_df=config.lda_max_df,
+                                          min_df=config.lda_min_df,
+                                          max_features=config.lda_max_features).fit(self.id2text_iterator())
+            lda = gensim.models.ldamulticore.LdaMulticore(corpus=corpus,
+                                                          id2word=corpus.id2word,
+                                                          num_topics=config.num_lda_topics,
+                                                          workers=self.workers,
+                                                          passes=1)
+            tfidf_model = corpus.to_vectorizer()
+        else:
+            tfidf_model = TfidfVectorizer(max_df=config.lda_max_df,
+                                          min_df=config.lda_min_df,
+                                          max_features=config.lda_max_features)
+            corpus = tfidf_model.fit_transform(self.id2text_iterator())
+            corpus = gensim.matutils.Sparse2Corpus(corpus, documents_columns=False)
+            id2word = {wid:word for word,wid in tfidf_model.vocabulary_.items()}
+            lda = gensim.models.ldamodel.LdaModel(corpus=corpus,
+                                                  id2word=id2word,
+                                                  num_topics=config.num_lda_topics,
+                                                  update_every=1,
+                                                  passes=1)
+
+        # save LDA model features and the vocabulary / idf (to infer topics for new pages later)
         lda.save(self.output_lda)
+        tfidf_model.stop_words_ = None  # only kept for introspection; huge for a full dump
+        with open(self.output_vectorizer, 'wb') as fout:
+            pickle.dump(tfidf_model, fout)
 
         # save topic distribution for each article
-        page_reprs = []
-        for i, page_repr in enumerate(lda[corpus]):
-            page_repr_alldim = [0.0] * config.num_lda_topics
-            for topic_idx, topic_prop in page_repr:
-                page_repr_alldim[topic_idx] = topic_prop
-            page_reprs.append([self.page_ids[i], page_repr[0][0]] + page_repr_alldim)
-
-        page_reprs = pd.DataFrame(page_reprs,
-                                  columns=['lda_pid', 'main_topic'] + ['topic{0}'.format(i) for i in range(config.num_lda_topics)])
-        page_reprs.set_index('lda_pid', inplace=True)
+        page_reprs = self.topic_distributions(lda, corpus, self.page_ids)
         page_reprs.to_csv(self.output_features_tsv, sep="\t")
 
         # save LDA overview
@@ -231,6 +359,62 @@ class ArticleLDA:
                                   ignore_index=True)
         topic_overview.to_csv(self.output_overview, sep='\t')
 
+    def topic_distributions(self, lda, corpus, page_ids):
+        """DataFrame (indexed by lda_pid) with main topic and proportion of every topic for each document."""
+        page_reprs = []
+        for i, page_repr in enumerate(lda[corpus]):
+            page_repr_alldim = [0.0] * config.num_lda_topics
+            for topic_idx, topic_prop in page_repr:
+                page_repr_alldim[topic_idx] = topic_prop
+            page_reprs.append([page_ids[i], page_repr[0][0]] + page_repr_alldim)
+
+        page_reprs = pd.DataFrame(page_reprs,
+                                  columns=['lda_pid', 'main_topic'] + ['topic{0}'.format(i) for i in range(config.num_lda_topics)])
+        page_reprs.set_index('lda_pid', inplace=True)
+        return page_reprs
+
+    def has_model(self):
+        return os.path.exists(self.output_lda) and os.path.exists(self.output_vectorizer)
+
+    def update_topic_features(self, page_ids, batch_size=10000):
+        """Infer topics with the saved model for the `page_ids` that are not yet in the features TSV.
+
+        Only the texts of those pages are parsed; results are appended to the TSV in batches.
+        Ids that yield no text (redirects, other namespaces, pages missing from the dump) are recorded
+        in the skipped file so that later updates do not look for them again.
+        """
+        lda = gensim.models.ldamodel.LdaModel.load(self.output_lda)
+        with open(self.output_vectorizer, 'rb') as fin:
+            tfidf_model = pickle.load(fin)
+        done = set()
+        if os.path.exists(self.output_features_tsv):
+            done = set(pd.read_csv(self.output_features_tsv, sep='\t', usecols=['lda_pid'])['lda_pid'])
+        skipped = set()
+        if os.path.exists(self.output_skipped):
+            with open(self.output_skipped, 'r') as fin:
+                skipped = set(int(line) for line in fin if line.strip())
+        self.restrict_ids = set(page_ids) - done - skipped
+        print("Inferring topics for {0} pages ({1} already in {2}; {3} without text in earlier updates).".format(
+            len(self.restrict_ids), len(done), self.output_features_tsv, len(skipped)))
+        if not self.restrict_ids:
+            return
+        texts = self.id2text_iterator()
+        header = not done
+        while True:
+            batch = list(itertools.islice(texts, batch_size))
+            if not batch:
+                break
+            corpus = gensim.matutils.Sparse2Corpus(tfidf_model.transform(batch), documents_columns=False)
+            page_reprs = self.topic_distributions(lda, corpus, self.page_ids[-len(batch):])
+            page_reprs.to_csv(self.output_features_tsv, sep="\t", mode='a', header=header)
+            header = False
+        # only recorded once the dump was read completely
+        no_text = self.restrict_ids - set(self.page_ids)
+        with open(self.output_skipped, 'a') as fout:
+            for pid in sorted(no_text):
+                fout.write("{0}\n".format(pid))
+        print("{0} pages without text recorded in {1}.".format(len(no_text), self.output_skipped))
+
 def id_check(lang, args, id2props=None, pageids=None):
     if not pageids:
         pageids = get_pageids(lang, args)
@@ -267,42 +451,125 @@ def get_pageview_data(lang, output_dir):
 
     exec_hive_stat2(query, filename)
 
+def get_pageview_dump_data(lang, date, sql_dir, dump_dir, output_fn, workers=1):
+    """Same output as get_pageview_data but aggregated from local user pageview dumps for the survey period."""
+    for table in ["page", "redirect"]:
+        if not get_sql_dump(lang, date, sql_dir, table):
+            raise FileNotFoundError("Could not get {0}".format(build_sql_dump_fn(lang, date, sql_dir, table)))
+    nodes, title_nodes = build_title_nodes(build_sql_dump_fn(lang, date, sql_dir, "page"),
+                                           build_sql_dump_fn(lang, date, sql_dir, "redirect"))
+    daily_files = user_pageview_files(dump_dir, config.survey_start_date, config.survey_end_date)
+    aggregate_pageviews(lang, daily_files, nodes, title_nodes, output_fn,
+                        work_dir=os.path.join(os.path.dirname(output_fn), "{0}_pageviews_tmp".format(lang)),
+                        workers=workers)
+
 # dictionary of pageid:title (except if non-focal language because page IDs might overlap, then lang-pageid:title)
 def get_all_pages(df, lang):
     id_to_title = {}
-    for ur in df.requests.apply(lambda x: {int(r['page_id']) if r['lang'] == lang else "{0}:{1}".format(r['lang'], r['page_id']):r["title"] for r in x}):
-        id_to_title.update(ur)
+    for trace in df.requests:
+        if trace is None:
+            continue
+        in_lang = trace.equals('lang', lang)
+        page_ids = trace.column('page_id')
+        langs = trace.column('lang')
+        pids = [int(pid) if focal else "{0}:{1}".format(l, pid) for pid, l, focal in zip(page_ids, langs, in_lang)]
+        id_to_title.update(zip(pids, trace.column('title')))
     return id_to_title
 
 
 def build_article_text_dump_fn(lang, date, output_dir):
     return os.path.join(output_dir, "[0}wiki-{1}-pages-articles.xml.bz2".format(lang, date))
 
-def build_sql_dump_fn(lang, date, output_dir):
-    return os.path.join(output_dir, "{0}wiki-{1}-page.sql.gz".format(lang, date))
+def build_sql_dump_fn(lang, date, output_dir, table="page"):
+    return os.path.join(output_dir, "{0}wiki-{1}-{2}.sql.gz".format(lang, date, table))
 
 def build_local_currentpage_dump_fn(lang, date):
     local_replicas = '/mnt/data/xmldatadumps/public'
     return os.path.join(local_replicas, '{0}wiki'.format(lang), date, '{0}wiki-{1}-pages-articles.xml.bz2'.format(lang, date))
 
-def download_dumps(lang, date, output_dir, dumptype="sql"):
+def build_local_multistream_dump_fn(lang, date):
+    local_replicas = '/mnt/data/xmldatadumps/public'
+    return os.path.join(local_replicas, '{0}wiki'.format(lang), date,
+                        '{0}wiki-{1}-pages-articles-multistream.xml.bz2'.format(lang, date))
+
+def build_local_multistream_index_fn(lang, date):
+    local_replicas = '/mnt/data/xmldatadumps/public'
+    return os.path.join(local_replicas, '{0}wiki'.format(lang), date,
+                        '{0}wiki-{1}-pages-articles-multistream-index.txt.bz2'.format(lang, date))
+
+def get_multistream_ranges(dump_fn, index_fn, page_ids=None):
+    """Byte ranges of the independent bz2 streams (~100 pages each) listed in a multistream index.
+
+    Index lines are `offset:page_id:title`; the header and footer streams are not listed.
+    Returns (start, end, wanted) triples. If `page_ids` is given, only streams containing one of
+    them are returned and `wanted` holds those ids (otherwise it is None: all pages are wanted).
+    """
+    offsets = []
+    wanted = []
+    with bz2.open(index_fn, 'rt') as fin:
+        for line in fin:
+            offset, page_id, _ = line.split(':', 2)
+            offset = int(offset)
+            if not offsets or offset != offsets[-1]:
+                offsets.append(offset)
+                wanted.append(None if page_ids is None else set())
+            if page_ids is not None and int(page_id) in page_ids:
+                wanted[-1].add(int(page_id))
+    ends = offsets[1:] + [os.path.getsize(dump_fn)]
+    return [(start, end, w) for start, end, w in zip(offsets, ends, wanted) if w is None or w]
+
+def extract_stream_texts(args):
+    """Worker: decompress bz2 streams and return (page id, title, text length, plaintext) in order
+    (all but the page id are None if the page is skipped)."""
+    dump_fn, streams = args
+    pages = []
+    with open(dump_fn, 'rb') as fin:
+        for start, end, wanted in streams:
+            fin.seek(start)
+            xml = bz2.BZ2Decompressor().decompress(fin.read(end - start)).decode('utf-8')
+            # streams hold a run of <page> elements (the last one also the closing </mediawiki>)
+            first, last = xml.find('<page>'), xml.rfind('</page>')
+            if first < 0 or last < 0:
+                continue
+            root = ElementTree.fromstring('<pages>' + xml[first:last + len('</page>')] + '</pages>')
+            for page in root.iter('page'):
+                page_id = int(page.findtext('id'))
+                if wanted is not None and page_id not in wanted:
+                    pages.append((page_id, None, None, None))
+                elif page.find('redirect') is None and page.findtext('ns') == '0':
+                    wikitext = page.findtext('revision/text') or ''
+                    pages.append((page_id, page.findtext('title'), len(wikitext),
+                                  mwparserfromhell.parse(wikitext).strip_code()))
+                else:
+                    pages.append((page_id, None, None, None))
+    return pages
+
+def download_dumps(lang, date, output_dir, dumptype="sql", table="page"):
     """WGET a dump file to local machine"""
     base_url = "https://dumps.wikimedia.org/{0}wiki/{1}".format(lang, date)
     if dumptype == "sql":
-        dump_url = build_sql_dump_fn(lang ,date, base_url)
-        output_fn = build_sql_dump_fn(lang, date, output_dir)
+        dump_url = build_sql_dump_fn(lang ,date, base_url, table)
+        output_fn = build_sql_dump_fn(lang, date, output_dir, table)
     elif dumptype == "article_text":
         dump_url = build_article_text_dump_fn(lang, date, base_url)
         output_fn = build_article_text_dump_fn(lang, date, output_dir)
     else:
         raise ValueError("Dumptype must be sql or article_text: {0}".format(dumptype))
-    download_dump_file(dump_url, output_fn)
+    return download_dump_file(dump_url, output_fn)
+
+
+def page_props_fn(lang, output_dir):
+    return os.path.join(output_dir, '{0}_page_props.tsv'.format(lang))
 
+def write_page_props(output_fn, id2props):
+    with open(output_fn, 'w') as fout:
+        tsvwriter = csv.writer(fout, delimiter="\t")
+        for pid in id2props:
+            tsvwriter.writerow([pid, id2props[pid].title, id2props[pid].length])
 
 def get_id2properties(lang, date, output_dir):
     """Build lookup for length of page (bytes)."""
-    Page = namedtuple('Page', ['title', 'length'])
-    output_fn = os.path.join(output_dir, '{0}_page_props.tsv'.format(lang))
+    output_fn = page_props_fn(lang, output_dir)
     id2props = {}
     if os.path.exists(output_fn):
         with open(output_fn, 'r') as fin:
@@ -312,6 +579,8 @@ def get_id2properties(lang, date, output_dir):
                 title = line[1]
                 plen = int(line[2])
                 id2props[pid] = Page(title, plen)
+    elif get_sql_dump(lang, date, output_dir):
+        id2props = get_page_props_from_sql(build_sql_dump_fn(lang, date, output_dir), output_fn)
     else:
         file_path = build_local_currentpage_dump_fn(lang, date)
         print("Gathering page properties from dump.")
@@ -323,12 +592,61 @@ def get_id2properties(lang, date, output_dir):
                     id2props[page.id] = Page(page.title, len(curr_rev.text))
                 if i % 1000000 == 0:
                     print("{0} pages evaluated. {1} retained.".format(i, len(id2props)))
-        with open(output_fn, 'w') as fout:
-            tsvwriter = csv.writer(fout, delimiter="\t")
-            for pid in id2props:
-                tsvwriter.writerow([pid, id2props[pid].title, id2props[pid].length])
+        write_page_props(output_fn, id2props)
+
+    return id2props
 
+def get_sql_dump(lang, date, output_dir, table="page"):
+    """Make sure the <table>.sql.gz dump is available locally (download if needed). Returns success."""
+    sql_fn = build_sql_dump_fn(lang, date, output_dir, table)
+    if os.path.exists(sql_fn):
+        return True
+    if download_dumps(lang, date, output_dir, dumptype="sql", table=table) == 0:
+        return True
+    if os.path.exists(sql_fn):
+        os.remove(sql_fn)  # wget -O leaves a partial / empty file behind
+    return False
+
+
+def get_page_props_from_sql(sql_fn, output_fn):
+    """Build id -> (title, length) lookup for articles from the page table (no article text needed).
+
+    page_len is the length of the current revision in bytes. Like the XML route, only
+    non-redirect pages in namespace 0 are kept.
+    """
+    id2props = {}
+    print("Gathering page properties from {0}".format(sql_fn))
+    columns = ('page_id', 'page_namespace', 'page_title', 'page_is_redirect', 'page_len')
+    with open(output_fn, 'w') as fout:
+        tsvwriter = csv.writer(fout, delimiter="\t")
+        for i, (pid, namespace, title, is_redirect, plen) in enumerate(iter_sql_rows(sql_fn, 'page', columns), start=1):
+            if namespace == 0 and not is_redirect:
+                # titles are stored with underscores in SQL but with spaces in the XML dump
+                page = id2props[pid] = Page(title.replace('_', ' '), plen)
+                tsvwriter.writerow([pid, page.title, page.length])
+            if i % 1000000 == 0:
+                print("{0} pages evaluated. {1} retained.".format(i, len(id2props)))
     return id2props
 
+def get_graph_features(lang, date, sql_dir, output_fn):
+    """Build <lang>_graph_features.csv (page id, pagerank, indegree, outdegree) from the SQL dumps."""
+    print("Building graph features at {0}".format(output_fn))
+    for table in ["page", "redirect", "pagelinks"]:
+        if not get_sql_dump(lang, date, sql_dir, table):
+            raise FileNotFoundError("Could not get {0}".format(build_sql_dump_fn(lang, date, sql_dir, table)))
+    pagelinks_fn = build_sql_dump_fn(lang, date, sql_dir, "pagelinks")
+    linktarget_fn = None
+    if 'pl_target_id' in sql_columns(pagelinks_fn, 'pagelinks'):
+        # newer dumps reference link targets by id
+        if not get_sql_dump(lang, date, sql_dir, "linktarget"):
+            raise FileNotFoundError("Could not get {0}".format(build_sql_dump_fn(lang, date, sql_dir, "linktarget")))
+        linktarget_fn = build_sql_dump_fn(lang, date, sql_dir, "linktarget")
+    build_graph_features(build_sql_dump_fn(lang, date, sql_dir, "page"),
+                         build_sql_dump_fn(lang, date, sql_dir, "redirect"),
+                         pagelinks_fn,
+                         linktarget_fn,
+                         output_fn,
+                         work_dir=os.path.join(os.path.dirname(output_fn), "{0}_graph_tmp".format(lang)))
+
 if __name__ == "__main__":
     main()
@@ -1,9 +1,6 @@
 import argparse
-import datetime
 import os
-import pickle
 import pytz
-import time
 from collections import Counter
 
 import numpy as np
@@ -13,161 +10,179 @@ import pandas as pd
 import sys
 sys.path.append(os.path.abspath(os.path.abspath(os.path.dirname(__file__)) + '/../../..'))
 
+from src.utils import article_store_dir
 from src.utils import config
+from src.utils import load_article_store
+from src.utils import Trace
+from src.utils import TraceTable
+from src.utils import write_feature_df
 
+# (feature name, referer class) pairs counted over the pageviews of the survey session
+SESSION_REFERER_COUNTS = (("session_num_external_searches", "external (search engine)"),
+                          ("session_num_internal", "internal"),
+                          ("session_num_external_nonsearches", "external"),
+                          ("session_num_noreferer", "none"))
+WEEKDAYS = np.array(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'], dtype=object)
+TOPIC_COLUMNS = ["topic_{0}".format(x) for x in range(config.num_lda_topics)]
 
-def sessionize(trace, interval=60):
-    """Break trace into separate sessions whenever there is interval 60 minute gap between requests."""
-    sessions = []
-    if len(trace) < 1:
-        print("No trace:", trace)
-    else:
-        session = [trace[0]]
-        for r in trace[1:]:
-            curr_ts = r['ts']
-            prev_ts = session[-1]['ts']
-            d = curr_ts - prev_ts
-            if d > datetime.timedelta(minutes=interval):
-                sessions.append(session)
-                session = [r, ]
-            else:
-                session.append(r)
 
-        sessions.append(session)
-    return sessions
+def sessionize(traces, interval=60):
+    """Break traces into separate sessions whenever there is an `interval` minute gap between requests.
 
+    Works on the whole TraceTable at once: returns a session id for every request, numbered
+    consecutively across users (the first request of each user always starts a new session).
+    """
+    ts = traces.epoch_seconds()
+    user = traces.user_index()
+    new_session = np.ones(len(ts), dtype=bool)
+    new_session[1:] = (user[1:] != user[:-1]) | (np.diff(ts) > interval * 60)
+    return np.cumsum(new_session) - 1
 
-def survey_session(df):
-    """Identify the session containing the survey request."""
-    sessions = df["sessions"]
-    survey_request = df["survey_request"]
-    survey_request_id = survey_request['id']
-    for s in sessions:
-        if survey_request_id in [r['id'] for r in s]:
-            return [r for r in s if 'is_pageview' in r and r['is_pageview'] == 'true']
 
+def num_sessions(traces, session_ids):
+    """Number of sessions across the survey time-period for each user."""
+    user = traces.user_index()
+    first = np.ones(len(session_ids), dtype=bool)
+    first[1:] = session_ids[1:] != session_ids[:-1]
+    return np.bincount(user[first], minlength=len(traces))
 
-def num_sessions(sessions):
-    """Number of sessions across the survey time-period"""
-    return len(sessions)
 
+def survey_session(traces, session_ids, survey_request_ids):
+    """Identify the session containing the survey request for each user.
 
-def single_surveyation(m):
-    """Return motivation if only one provided."""
-    if len(m.split('|')) == 1:
-        return m
-    return None
+    Returns the (global) session id per user, -1 if the survey request was not found.
+    """
+    user = traces.user_index()
+    hits = np.flatnonzero(traces.columns['id'] == np.repeat(survey_request_ids, traces.lengths()))
+    survey_row = np.full(len(traces), -1, dtype=np.int64)
+    # reversed so that the first hit per user wins
+    survey_row[user[hits][::-1]] = hits[::-1]
+    return np.where(survey_row >= 0, session_ids[survey_row], -1)
 
 
-def get_survey_local_time(dt, timezone):
-    """Convert UTC timestamp to local time based on webrequest timezone (based on IP)"""
-    utc_dt = pytz.utc.localize(dt, is_dst=None)
-    try:
-        return utc_dt.astimezone(pytz.timezone(timezone))
-    except:
-        return None
+def survey_session_rows(traces, session_ids, survey_sessions):
+    """Rows of the pageviews in each user's survey session (grouped by user and in time order)."""
+    user = traces.user_index()
+    user_session = survey_sessions[user]
+    return np.flatnonzero((user_session >= 0) & (session_ids == user_session) & traces.equals('is_pageview', 'true'))
 
 
-def get_survey_local_time_hour(dt):
-    """Get hour of day when survey was taken as feature."""
-    try:
-        return dt.hour
-    except:
-        return None
+def survey_session_pageviews(traces, rows, survey_sessions):
+    """Pageviews in each user's survey session as Trace views (None if there is no survey session)."""
+    bounds = np.searchsorted(traces.user_index()[rows], np.arange(len(traces) + 1))
+    return [Trace(traces, rows[bounds[u]:bounds[u + 1]]) if survey_sessions[u] >= 0 else None
+            for u in range(len(traces))]
 
 
-def get_survey_local_time_dayofweek(dt):
-    """Get day of week when survey was taken."""
-    try:
-        weekday = dt.weekday()
-        weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        return weekdays[weekday]
-    except:
-        return None
+def session_features(traces, rows, survey_request):
+    """Compute all session-level features at once as grouped reductions over the survey session rows.
 
+    Returns a DataFrame with one row per user: counts are int64, the rest float64 (NaN where
+    undefined, e.g. the average time difference of a single-pageview session).
+    """
+    num_users = len(traces)
+    user = traces.user_index()[rows]
+    bounds = np.searchsorted(user, np.arange(num_users + 1))
+    length = np.diff(bounds)
+    multiple = length > 1
+
+    # unix timestamps (seconds): subtract and then divide by 60 to get minutes.
+    # the average of consecutive time differences is just (last - first) / (length - 1)
+    ts = traces.epoch_seconds(rows).astype(np.float64)
+    time_length = np.zeros(num_users)
+    time_length[multiple] = (ts[bounds[1:][multiple] - 1] - ts[bounds[:-1][multiple]]) / 60.
+    avg_time_diff = np.full(num_users, np.nan)
+    avg_time_diff[multiple] = time_length[multiple] / (length[multiple] - 1)
+
+    # position of the (first) survey request within the session
+    survey_ids = np.array([r['id'] for r in survey_request])
+    position = np.arange(len(rows)) - bounds[:-1][user]
+    hits = np.flatnonzero(traces.columns['id'][rows] == survey_ids[user])
+    survey_position = np.full(num_users, -1)
+    survey_position[user[hits][::-1]] = position[hits][::-1]
+    rel_position = np.full(num_users, np.nan)
+    found = multiple & (survey_position >= 0)
+    rel_position[found] = survey_position[found] / (length[found] - 1)
+
+    # views of the survey article
+    survey_titles = np.array([traces.code('title', r['title']) for r in survey_request])
+    num_article = np.bincount(user[traces.columns['title'][rows] == survey_titles[user]], minlength=num_users)
+
+    # referer class counts: one bincount over (user, referer class) pairs for all classes
+    # (the extra last slot collects other and missing referer classes)
+    num_classes = len(SESSION_REFERER_COUNTS)
+    class_slot = np.full(len(traces.vocabs['referer_class']) + 1, num_classes)
+    for i, (_, referer_class) in enumerate(SESSION_REFERER_COUNTS):
+        code = traces.code('referer_class', referer_class)
+        if code >= 0:
+            class_slot[code] = i
+    pairs = user * (num_classes + 1) + class_slot[traces.columns['referer_class'][rows]]
+    referer_counts = np.bincount(pairs, minlength=num_users * (num_classes + 1)).reshape(num_users, -1)
+
+    block = pd.DataFrame({'session_length': length.astype(np.int64),
+                          'session_time_length': time_length,
+                          'session_rel_position': rel_position,
+                          'session_avg_time_diff': avg_time_diff,
+                          'session_num_article': num_article.astype(np.int64)})
+    for i, (feature, _) in enumerate(SESSION_REFERER_COUNTS):
+        block[feature] = referer_counts[:, i].astype(np.int64)
+    return block
 
-def session_length(session):
-    """Number of pageviews in session."""
-    return len(session)
-
-
-def session_time_length(session):
-    """Length of time of session."""
-    if len(session) < 2:
-        return 0
-    else:
-        start = session[0]['ts']
-        end = session[-1]['ts']
-
-        # convert to unix timestamp
-        start_ts = time.mktime(start.timetuple())
-        end_ts = time.mktime(end.timetuple())
-
-        # they are now in seconds, subtract and then divide by 60 to get minutes.
-        return (end_ts - start_ts) / 60.
-
-
-def session_avg_time_diff(session):
-    """Average time between pageviews during session."""
-    if len(session) < 2:
-        return None
-    else:
-        time_diffs = []
-        for i in range(len(session) - 1):
-            curr_pv = session[i]['ts']
-            next_pv = session[i + 1]['ts']
-            curr_ts = time.mktime(curr_pv.timetuple())
-            next_ts = time.mktime(next_pv.timetuple())
-            time_diffs.append((next_ts - curr_ts) / 60.)
-        return np.average(np.array(time_diffs))
-
-
-def session_num_article(df):
-    """Number of times article with survey request was viewed in the session."""
-    session = df.session
-    survey_request = df.survey_request
-    num = 0
-    for r in session:
-        if r['title'] == survey_request['title']:
-            num += 1
-    return num
-
-
-def session_position(df):
-    """Proportion of way through session in which survey was clicked."""
-    for i, r in enumerate(df.session):
-        if r["id"] == df.survey_request["id"]:
-            if len(df.session) == 1.:
-                return None
-            else:
-                return i / (len(df.session) - 1)
+
+def single_surveyation(m):
+    """Return motivation if only one provided."""
+    if len(m.split('|')) == 1:
+        return m
+    return None
+
+
+def get_survey_local_time(dt_utc, timezones):
+    """Convert UTC timestamps to local time based on webrequest timezone (based on IP).
+
+    Rows are converted together per distinct timezone. Returns the local hour and day of week
+    when the survey was taken as features (None for unknown timezones or missing timestamps).
+    """
+    utc = pd.DatetimeIndex(pd.to_datetime(dt_utc.values))
+    if utc.tz is None:
+        utc = utc.tz_localize('UTC')
+    hour = np.full(len(utc), np.nan)
+    weekday = np.full(len(utc), None, dtype=object)
+    zone_codes, zones = pd.factorize(timezones.values)
+    zone_codes[utc.isna()] = -1
+    order = np.argsort(zone_codes, kind='stable')
+    bounds = np.searchsorted(zone_codes[order], np.arange(len(zones) + 1))
+    for i, zone in enumerate(zones):
+        try:
+            tz = pytz.timezone(zone)
+        except (pytz.UnknownTimeZoneError, AttributeError):
+            continue
+        rows = order[bounds[i]:bounds[i + 1]]
+        local_time = utc[rows].tz_convert(tz)
+        hour[rows] = local_time.hour
+        weekday[rows] = WEEKDAYS[local_time.weekday]
+    return pd.Series(hour, index=dt_utc.index), pd.Series(weekday, index=dt_utc.index)
 
 
 def session_access_method(session):
     """Most common access method in session (categorical)."""
-    access_method = Counter([r['access_method'] for r in session]).most_common(1)[0][0]
+    access_method = Counter(session.column('access_method')).most_common(1)[0][0]
     return access_method
 
 
 def session_referer_class(session):
     """Most common referer class in session (categorical)."""
-    referer_class = Counter([r['referer_class'] for r in session]).most_common(1)[0][0]
+    referer_class = Counter(session.column('referer_class')).most_common(1)[0][0]
     return referer_class
 
 
 def session_num_pageviews(session):
     """Number of pageviews in session."""
-    return len([r for r in session if 'is_pageview' in r and r['is_pageview'] == 'true'])
-
-
-def session_num_access_methods(session, access_method):
-    """Number of times a given access method is associated with a pageview in session."""
-    return len([r for r in session if 'referer_class' in r and r['referer_class'] == access_method])
+    return int(session.equals('is_pageview', 'true').sum())
 
 
 def requests_length(requests):
     """Total number of pageviews across all sessions."""
-    return len([r for r in requests if 'is_pageview' in r and r['is_pageview'] == 'true'])
+    return int(requests.equals('is_pageview', 'true').sum())
 
 
 def generate_survey_features(df):
@@ -180,9 +195,8 @@ def generate_survey_features(df):
         for col in dummies:
             df["motivation_" + col] = dummies[col]
 
-    df['local_time'] = df.apply(lambda x: get_survey_local_time(x['survey_dt_utc'], x['geo_data']['timezone']), axis=1)
-    df['local_time_hour'] = df['local_time'].apply(get_survey_local_time_hour)
-    df['local_time_weekday'] = df['local_time'].apply(get_survey_local_time_dayofweek)
+    df['local_time_hour'], df['local_time_weekday'] = get_survey_local_time(
+        df['survey_dt_utc'], df['geo_data'].apply(lambda x: x['timezone']))
     df['continent'] = df['geo_data'].apply(lambda x: x['continent'])
     df['country_code'] = df['geo_data'].apply(lambda x: x['country_code'])
     # replace all countries with less than 500 rows ==> 'other'
@@ -200,36 +214,25 @@ def generate_survey_features(df):
     return df
 
 
-def generate_session_features(df):
+def generate_session_features(df, interval=60):
     """Generate features about the specific survey session of pageviews."""
     print("generating survey session features")
-    df['sessions'] = df['requests'].apply(sessionize)
-    df['num_sessions'] = df['sessions'].apply(num_sessions)
-    # df['session'] = df[['sessions','survey_request']].apply(survey_session,axis=1)
-    # replace the above with a loop due to: https://github.com/pandas-dev/pandas/issues/14217
-    session_list = []
-    for _, l in df.iterrows():
-        session_list.append(survey_session(l))
-    df["session"] = session_list
-
-    df['session_length'] = df['session'].apply(session_length)
-    df['session_time_length'] = df['session'].apply(session_time_length)
-    df['session_rel_position'] = df.apply(session_position, axis=1)
+    traces = TraceTable.from_traces(df['requests'])
+    df['requests'] = traces.traces()
+    session_ids = sessionize(traces, interval)
+    df['num_sessions'] = num_sessions(traces, session_ids)
+    survey_request_ids = df['survey_request'].apply(lambda x: x['id']).values
+    survey_sessions = survey_session(traces, session_ids, survey_request_ids)
+    rows = survey_session_rows(traces, session_ids, survey_sessions)
+    df["session"] = survey_session_pageviews(traces, rows, survey_sessions)
+
+    block = session_features(traces, rows, df['survey_request'])
+    for col in block:
+        df[col] = block[col].values
     # df['session_access_method'] = df['session'].apply(session_access_method)
-    df["session_avg_time_diff"] = df['session'].apply(session_avg_time_diff)
-    df["session_num_article"] = df[['session', 'survey_request']].apply(session_num_article, axis=1)
     # df["session_num_pageviews"] = df['session'].apply(session_num_pageviews)
     # df["session_avg_num_pageviews"] = df["session_num_pageviews"] / df['session_length']
     # df['session_referer_class'] = df['session'].apply(session_referer_class)
-    df["session_num_external_searches"] = df['session'].apply(
-        lambda x: session_num_access_methods(x, 'external (search engine)'))
-    # df["session_avg_num_external_searches"] = df["session_num_external_searches"] / df['session_length']
-    df["session_num_internal"] = df['session'].apply(lambda x: session_num_access_methods(x, "internal"))
-    # df["session_avg_num_internal"] = df["session_num_internal"] / df['session_length']
-    df["session_num_external_nonsearches"] = df['session'].apply(lambda x: session_num_access_methods(x, "external"))
-    # df["session_avg_external_nonsearches"] = df["session_num_external_nonsearches"] / df['session_length']
-    df["session_num_noreferer"] = df['session'].apply(lambda x: session_num_access_methods(x, "none"))
-    # df["session_avg_noreferer"] = df["session_num_noreferer"] / df['session_length']
 
     return df
 
@@ -243,7 +246,6 @@ def generate_request_features(df):
 
 def delete_columns(df):
     """Trim down data."""
-    del df["sessions"]
     del df["requests"]
     del df["session"]
     del df["session_articles"]
@@ -252,7 +254,6 @@ def delete_columns(df):
     del df["geo_data"]
     del df["client_token"]
     del df["monthly_pageviews"]
-    del df["local_time"]
 
     if 'motivation' in df:
         del df["survey_submit_dt"]
@@ -265,74 +266,78 @@ def delete_columns(df):
 
 
 def topic_entropy(topics):
-    """Compute topic entropy -- i.e. how specific / general the article topic was."""
-    entropy = 0
-    for p in topics:
-        entropy += -p * np.log2(p)
-    return entropy
+    """Compute topic entropy -- i.e. how specific / general the article topic was (one value per row)."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.sum(topics * np.log2(topics), axis=-1)
 
 
-def generate_article_features(df, df_articles):
+def generate_article_features(df, articles):
     """Generate features specific to the article on which the survey was responded."""
     print("generating article features")
 
     df["article_title"] = df["survey_request"].apply(lambda x: x["title"].lower())
-    df_all = pd.merge(left=df, right=df_articles, left_on="article_title", right_on="title", how="left")
+    df_all = pd.concat([df, articles.to_frame(articles.find(df["article_title"]), index=df.index)], axis=1)
 
-    topics = ["topic_{0}".format(x) for x in range(20)]
-    df_all["topic_entropy"] = df_all[topics].apply(topic_entropy, axis=1)
+    df_all["topic_entropy"] = topic_entropy(df_all[TOPIC_COLUMNS].values.astype(np.float32))
     return df_all
 
 
-def generate_article_session_features(df, df_a):
+def generate_article_session_features(df, articles):
     """Generate features about the articles viewed across all sessions."""
     print("generate article session features")
-    df["session_avg_pagerank_difference"] = [session_article_pagerank_diff_avg(x, df_a) for x in df["session"]]
-    df["session_avg_topic_distance"] = [session_topic_difference_avg(x, df_a) for x in df["session"]]
+    article_ids, lengths = session_article_ids(df["session"], articles)
+    # one extra NaN row at the end for titles that are not in the article store (id -1)
+    pagerank = np.append(articles.columns["pagerank"].astype(np.float64), np.nan)
+    topics = np.vstack([articles.topics, np.full((1, articles.num_topics), np.nan, dtype=np.float32)])
+    pagerank_diff, topic_distance = session_article_trajectories(article_ids, lengths, pagerank, topics)
+    df["session_avg_pagerank_difference"] = pagerank_diff
+    df["session_avg_topic_distance"] = topic_distance
     return df
 
 
-def session_article_pagerank_diff_avg(session, df_articles):
-    """Average change in pagerank across the entire session.
+def session_article_ids(sessions, articles):
+    """Article store rows of all session pageviews, concatenated, plus the length of each session.
 
-    NOTE: this is based on the first and last articles viewed, not
-    the actual trajectory of pageviews.
+    Titles are looked up once per distinct title in the trace table instead of once per pageview.
     """
-    if len(session) < 2:
-        return np.nan
-
-    first_title = session[0]["title"].lower()
-    pr_first = df_articles.loc[first_title]["pagerank"]
-    last_title = session[-1]["title"].lower()
-    pr_last = df_articles.loc[last_title]["pagerank"]
-
-    return (pr_first - pr_last) / (len(session) - 1)
-
-
-def session_topic_difference_avg(ses, df_articles):
-    """Average magnitude of difference between topics between each pageview.
-
-    High => session that involves jumping around many different topics
-    Low => session that involves staying in the same topic area
+    lengths = np.array([0 if s is None else len(s) for s in sessions], dtype=np.int64)
+    sessions = [s for s in sessions if s is not None]
+    if not sessions:
+        return np.zeros(0, dtype=np.int64), lengths
+    table = sessions[0].table
+    rows = np.concatenate([s.row_index() for s in sessions])
+    # the extra -1 at the end is picked by requests without a title (code -1)
+    vocab_ids = np.append(articles.find(table.vocabs['title']), -1)
+    return vocab_ids[table.columns['title'][rows]], lengths
+
+
+def session_article_trajectories(article_ids, lengths, pagerank, topics):
+    """Average pagerank change and topic distance of consecutive pageviews for each session.
+
+    `article_ids` are the article rows of all sessions concatenated (`lengths` pageviews each).
+    High topic distance => session that involves jumping around many different topics
+    Low topic distance => session that involves staying in the same topic area
+    NOTE: the pagerank change is based on the first and last articles viewed, not
+    the actual trajectory of pageviews. Sessions with fewer than two pageviews get NaN.
     """
-    topics = ["topic_{0}".format(x) for x in range(20)]
-    if len(ses) < 2:
-        return np.nan
-
-    all_diffs = []
-    curr_title = None
-    for r in ses:
-        title = r["title"].lower()
-        if curr_title == None:
-            curr_title = title
-            curr_topics = df_articles.loc[curr_title][topics].values
-        else:
-            prev_topics = curr_topics
-            curr_title = title
-            curr_topics = df_articles.loc[curr_title][topics].values
-            diff = np.abs(prev_topics - curr_topics)
-            all_diffs.append(np.sum(diff))
-    return np.mean(all_diffs)
+    num_sessions = len(lengths)
+    bounds = np.zeros(num_sessions + 1, dtype=np.int64)
+    np.cumsum(lengths, out=bounds[1:])
+    multiple = lengths > 1
+
+    pagerank_diff = np.full(num_sessions, np.nan)
+    first_pr = pagerank[article_ids[bounds[:-1][multiple]]]
+    last_pr = pagerank[article_ids[bounds[1:][multiple] - 1]]
+    pagerank_diff[multiple] = (first_pr - last_pr) / (lengths[multiple] - 1)
+
+    # L1 distance between the topic vectors of all consecutive pairs within a session
+    session = np.repeat(np.arange(num_sessions), lengths)
+    pairs = np.flatnonzero(session[1:] == session[:-1])
+    distances = np.abs(topics[article_ids[pairs + 1]] - topics[article_ids[pairs]]).sum(axis=1)
+    topic_distance = np.full(num_sessions, np.nan)
+    topic_distance[multiple] = (np.bincount(session[pairs], weights=distances, minlength=num_sessions)[multiple]
+                                / (lengths[multiple] - 1))
+    return pagerank_diff, topic_distance
 
 
 def select_and_rename(df, survey):
@@ -340,7 +345,7 @@ def select_and_rename(df, survey):
     df = df.rename(columns={"indegree": "article_indegree",
                             "outdegree": "article_outdegree",
                             "pagerank": "article_pagerank",
-                            "page_lengths": "article_textlength"})
+                            "page_length": "article_textlength"})
 
     df = df.rename(columns={f"topic_{i}": f"t{i}" for i in range(20)})
     features = ['host',
@@ -426,6 +431,15 @@ def main():
     parser.add_argument("--article_folder",
                         default=config.article_folder,
                         help="Folder with article-specific features")
+    parser.add_argument("--session_interval",
+                        default=60,
+                        type=int,
+                        help="Gap (minutes) between requests that starts a new session.")
+    parser.add_argument("--sample_chunk_size",
+                        default=0,
+                        type=int,
+                        help="If > 0, write the sample features in files of this many rows "
+                             "(read chunk by chunk by the streaming propensity model).")
     args = parser.parse_args()
 
     ## create feature dataframe for survey participants
@@ -435,14 +449,13 @@ def main():
         df = pd.read_pickle(os.path.join(args.response_dir, 'joined_responses_and_traces_anon_{0}.p'.format(lang)))
         print("Length of df:", len(df))
         df = generate_survey_features(df)
-        df = generate_session_features(df)
+        df = generate_session_features(df, args.session_interval)
         df = generate_request_features(df)
-        df_articles = pickle.load(open(os.path.join(args.article_folder, "article_features_{0}.p".format(lang)), "rb"))
-        df = generate_article_features(df, df_articles)
-        df_articles.set_index("title", inplace=True)
-        df = generate_article_session_features(df, df_articles)
+        articles = load_article_store(article_store_dir(args.article_folder, lang))
+        df = generate_article_features(df, articles)
+        df = generate_article_session_features(df, articles)
         df = select_and_rename(df, True)
-        df.to_pickle(os.path.join(args.featuredf_dir, 'survey_features_{0}.p'.format(lang)))
+        write_feature_df(df, args.featuredf_dir, 'survey', lang)
 
     ## create feature dataframe for random sample
     for lang in args.languages:
@@ -451,14 +464,13 @@ def main():
         df = pd.read_pickle(os.path.join(args.sample_dir, "samples_anon_{0}.p".format(lang)))
         print("Length of df:", len(df))
         df = generate_survey_features(df)
-        df = generate_session_features(df)
+        df = generate_session_features(df, args.session_interval)
         df = generate_request_features(df)
-        df_articles = pickle.load(open(os.path.join(args.article_folder, "article_features_{0}.p".format(lang)), "rb"))
-        df = generate_article_features(df, df_articles)
-        df_articles.set_index("title", inplace=True)
-        df = generate_article_session_features(df, df_articles)
+        articles = load_article_store(article_store_dir(args.article_folder, lang))
+        df = generate_article_features(df, articles)
+        df = generate_article_session_features(df, articles)
         df = select_and_rename(df, False)
-        df.to_pickle(os.path.join(args.featuredf_folder, 'sample_features_{0}.p'.format(lang)))
+        write_feature_df(df, args.featuredf_dir, 'sample', lang, args.sample_chunk_size)
 
 
 if __name__ == "__main__":
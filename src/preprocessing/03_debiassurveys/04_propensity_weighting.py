@@ -1,17 +1,324 @@
 import argparse
+from multiprocessing import Pool
 import os
+import shutil
 import sys
+import time
 
+import numpy as np
 import pandas as pd
 from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
 from sklearn.linear_model import LogisticRegression
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import Imputer
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import StratifiedKFold
+from scipy import sparse
+from threadpoolctl import threadpool_limits
 
 # hacky way to make sure utils is visible
 sys.path.append(os.path.abspath(os.path.abspath(os.path.dirname(__file__)) + '/../../..'))
 
 from src.utils import config
+from src.utils import iter_feature_chunks
+from src.utils import read_feature_df
+from src.utils import sample_feature_df
+from src.utils.design import DesignMatrixBuilder
+from src.utils.design import DesignMatrix
+
+
+# control strata of the stratified subsample
+STRATA = ['country_code', 'host', 'referer_class']
+
+_worker_data = None
+
+
+def hist_features(df, features_categorical):
+    """Features for HistGradientBoostingClassifier: categoricals as integer codes (missing values stay missing)."""
+    X = df.copy()
+    for c in features_categorical:
+        X[c] = X[c].astype('category').cat.codes.replace(-1, np.nan)
+    return X
+
+
+def make_model(engine, categorical=None, max_iter=500):
+    """Unfitted propensity model.
+
+    gbc: GradientBoostingClassifier (single core)
+    hist: HistGradientBoostingClassifier; uses all cores, handles missing values and the `categorical`
+          columns natively (no imputation or dummies) and stops early when the loss on a 10% held-out
+          split stops improving
+    logreg: LogisticRegression
+    gbc and logreg expect the imputed design matrix of DesignMatrixBuilder.
+    """
+    if engine == "hist":
+        return HistGradientBoostingClassifier(max_iter=max_iter,
+                                              categorical_features=categorical,
+                                              early_stopping=True,
+                                              validation_fraction=0.1,
+                                              n_iter_no_change=10,
+                                              random_state=0,
+                                              verbose=1)
+    if engine == "gbc":
+        return GradientBoostingClassifier(n_estimators=max_iter, verbose=1)
+    return LogisticRegression()
+
+
+def model_input(engine, X):
+    """The DesignMatrix in the format the model fits fastest on: dense float32 for gradient boosting (it
+    would convert sparse input to dense columns itself), CSR for logistic regression. Other inputs (the
+    hist features) are passed as they are."""
+    if isinstance(X, DesignMatrix):
+        return X.dense() if engine == "gbc" else X.csr()
+    return X
+
+
+def take_rows(X, rows):
+    if isinstance(X, DesignMatrix):
+        return X.rows(rows)
+    return X[rows]
+
+
+def in_sample_weights(engine, X, Y, categorical=None, sample_weight=None):
+    """Inverse propensity weights from a model fit on all rows."""
+    X = model_input(engine, X)
+    model = make_model(engine, categorical)
+    model.fit(X, Y, sample_weight=sample_weight)
+    if engine == "hist":
+        print("Stopped after {0} iterations".format(model.n_iter_))
+    return 1 / model.predict_proba(X)[:, 1]
+
+
+def _init_worker(data_dir, threads):
+    # pool processes only: don't oversubscribe the cores with the model's own threads (OpenMP / BLAS)
+    threadpool_limits(threads)
+    _load_worker_data(data_dir)
+
+
+def _load_worker_data(data_dir):
+    global _worker_data
+    Y = np.load(os.path.join(data_dir, "Y.npy"), mmap_mode='r')
+    W = None
+    if os.path.exists(os.path.join(data_dir, "W.npy")):
+        W = np.load(os.path.join(data_dir, "W.npy"), mmap_mode='r')
+    if os.path.exists(os.path.join(data_dir, "X.npy")):
+        X = np.load(os.path.join(data_dir, "X.npy"), mmap_mode='r')
+    else:
+        onehot = sparse.csr_matrix(tuple(np.load(os.path.join(data_dir, "onehot_" + name + ".npy"), mmap_mode='r')
+                                         for name in ("data", "indices", "indptr")),
+                                   shape=(len(Y), int(np.load(os.path.join(data_dir, "num_onehot.npy")))),
+                                   copy=False)
+        X = DesignMatrix(np.load(os.path.join(data_dir, "numeric.npy"), mmap_mode='r'), onehot)
+    _worker_data = (X, Y, W)
+
+
+def fit_fold(engine, categorical, train_rows, test_rows):
+    """Fit on train_rows of the shared design matrix; propensity scores of test_rows."""
+    X, Y, W = _worker_data
+    model = make_model(engine, categorical)
+    model.fit(model_input(engine, take_rows(X, train_rows)), Y[train_rows],
+              sample_weight=None if W is None else W[train_rows])
+    return test_rows, model.predict_proba(model_input(engine, take_rows(X, test_rows)))[:, 1]
+
+
+def cross_fit_weights(engine, X, Y, work_dir, categorical=None, folds=5, workers=1, sample_weight=None):
+    """Inverse propensity weights from out-of-fold scores of `folds` models (stratified k-fold).
+
+    The fold models are trained concurrently in a pool of `workers` processes. The design matrix
+    (DesignMatrix blocks or a dense array) is written once to work_dir and memory-mapped by the workers
+    instead of being pickled to each fold.
+    """
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    Y = np.asarray(Y)
+    if isinstance(X, DesignMatrix):
+        np.save(os.path.join(work_dir, "numeric.npy"), X.numeric)
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(work_dir, "onehot_" + name + ".npy"), getattr(X.onehot, name))
+        np.save(os.path.join(work_dir, "num_onehot.npy"), X.onehot.shape[1])
+    else:
+        np.save(os.path.join(work_dir, "X.npy"), np.asarray(X, dtype=np.float64))
+    np.save(os.path.join(work_dir, "Y.npy"), Y)
+    if sample_weight is not None:
+        np.save(os.path.join(work_dir, "W.npy"), np.asarray(sample_weight, dtype=np.float64))
+    splits = StratifiedKFold(n_splits=folds, shuffle=True, random_state=0).split(np.zeros(len(Y)), Y)
+    args = [(engine, categorical, train_rows, test_rows) for train_rows, test_rows in splits]
+    threads = max(1, os.cpu_count() // workers)
+    scores = np.zeros(len(Y))
+    if workers > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(work_dir, threads)) as pool:
+            for test_rows, fold_scores in pool.starmap(fit_fold, args):
+                scores[test_rows] = fold_scores
+    else:
+        # single process: the models keep all cores
+        _load_worker_data(work_dir)
+        for a in args:
+            test_rows, fold_scores = fit_fold(*a)
+            scores[test_rows] = fold_scores
+    shutil.rmtree(work_dir)
+    return 1 / scores
+
+
+def fit_design_streaming(design, df_survey, sample_chunks):
+    """First pass: fit the design vocabulary and standardization over the survey rows and all control chunks.
+
+    Returns the number of control rows.
+    """
+    sizes = []
+
+    def chunks():
+        yield df_survey
+        for chunk in sample_chunks():
+            sizes.append(len(chunk))
+            yield chunk
+
+    design.fit_chunks(chunks())
+    return sum(sizes)
+
+
+def streaming_logreg_weights(design, df_survey, sample_chunks, num_sample_rows, epochs=5, batch_size=100000):
+    """Inverse propensity weights of the survey rows from a logistic regression trained chunk by chunk.
+
+    `sample_chunks()` returns a new iterator over the control feature chunks. In each epoch, every control
+    chunk is combined with its proportional share of the (shuffled) survey rows so that every partial_fit
+    sees both classes; numeric features are standardized with the statistics of the design. Survey rows
+    are scored in batches of batch_size, so memory is bounded by one chunk however large the control set.
+
+    With few survey rows among many controls, plain SGD (and its default 'optimal' step size, which
+    grows as alpha shrinks) does not converge to calibrated propensities. Instead the classes are
+    balanced with class weights, the averaged SGD iterate is used with a small constant step size, and
+    the intercept is shifted back by log(class weight) afterwards (prior correction for case-control
+    sampling), which gives the propensities of the unweighted model.
+    """
+    survey_weight = num_sample_rows / len(df_survey)
+    model = SGDClassifier(loss='log_loss',
+                          alpha=1. / (2 * num_sample_rows),
+                          learning_rate='constant',
+                          eta0=0.03 / survey_weight,
+                          average=True,
+                          class_weight={1: survey_weight, 0: 1.},
+                          random_state=0)
+    rng = np.random.RandomState(0)
+    for epoch in range(epochs):
+        survey_order = rng.permutation(len(df_survey))
+        seen = 0
+        survey_pos = 0
+        for chunk in sample_chunks():
+            seen += len(chunk)
+            survey_end = int(round(len(df_survey) * seen / num_sample_rows))
+            survey_rows = df_survey.iloc[survey_order[survey_pos:survey_end]]
+            survey_pos = survey_end
+            X = sparse.vstack([design.transform(survey_rows, standardize=True).csr(),
+                               design.transform(chunk, standardize=True).csr()], format='csr')
+            Y = np.r_[np.ones(len(survey_rows), dtype=int), np.zeros(len(chunk), dtype=int)]
+            order = rng.permutation(len(Y))
+            model.partial_fit(X[order], Y[order], classes=[0, 1])
+        print("epoch {0}: {1} control and {2} survey rows".format(epoch + 1, seen, survey_pos))
+    model.intercept_ -= np.log(survey_weight)
+    scores = []
+    for start in range(0, len(df_survey), batch_size):
+        X = design.transform(df_survey.iloc[start:start + batch_size], standardize=True).csr()
+        scores.append(model.predict_proba(X)[:, 1])
+    return 1 / np.concatenate(scores)
+
+
+def check_streaming_logreg(design, df_survey, df_sample, control_weight, num_sample_rows, weights):
+    """Report how close streaming weights are to a batch LogisticRegression on the (in-memory) control subsample.
+
+    Controls are weighted to stand for all num_sample_rows control rows (importance weights if the
+    subsample has them), so that both models estimate the same propensities.
+    """
+    if control_weight is None:
+        control_weight = np.full(len(df_sample), num_sample_rows / len(df_sample))
+    X = sparse.vstack([design.transform(df_survey, standardize=True).csr(),
+                       design.transform(df_sample, standardize=True).csr()], format='csr')
+    Y = np.r_[np.ones(len(df_survey), dtype=int), np.zeros(len(df_sample), dtype=int)]
+    model = LogisticRegression(max_iter=1000)
+    model.fit(X, Y, sample_weight=np.r_[np.ones(len(df_survey)), control_weight])
+    reference = 1 / model.predict_proba(X[:len(df_survey)])[:, 1]
+    compare_weights(weights, reference, "weights_logreg, streaming vs. batch LogisticRegression on {0} control rows"
+                    .format(len(df_sample)))
+
+
+def strata_keys(df):
+    keys = df[STRATA[0]].astype(str)
+    for c in STRATA[1:]:
+        keys = keys + "|" + df[c].astype(str)
+    return keys
+
+
+def stratified_inclusion(sample_chunks, size, min_per_stratum=20):
+    """Inclusion probabilities of a stratified (STRATA) subsample of about `size` control rows.
+
+    Strata are allocated proportionally to their size, but keep at least min_per_stratum rows
+    (all rows of smaller strata) so that rare country / host / referer combinations are represented.
+    """
+    counts = pd.Series(dtype=np.float64)
+    for chunk in sample_chunks():
+        counts = counts.add(strata_keys(chunk).value_counts(), fill_value=0)
+    allocation = np.maximum(counts * size / counts.sum(), np.minimum(counts, min_per_stratum))
+    rates = (allocation / counts).clip(upper=1)
+    print("{0} strata; {1:.0f} of {2:.0f} control rows expected in the subsample".format(
+        len(counts), (rates * counts).sum(), counts.sum()))
+
+    def inclusion(chunk):
+        return strata_keys(chunk).map(rates).fillna(1).values
+
+    return inclusion
+
+
+def coreset_inclusion(design, sample_chunks, size):
+    """Inclusion probabilities of a lightweight coreset of about `size` control rows (Bachem et al., 2018).
+
+    Rows far from the mean in the standardized design space are more likely to matter for the fit, so
+    row x is kept with probability size * (1/2N + 1/2 d(x)^2 / sum d^2), d being the distance to the mean.
+    Sums of the columns and of the squared norms give the mean and sum d^2 in one pass.
+    """
+    num_rows = 0
+    column_sum = np.zeros(len(design.columns))
+    norm_sq = 0.
+    for chunk in sample_chunks():
+        X = design.transform(chunk, standardize=True).csr()
+        num_rows += X.shape[0]
+        column_sum += np.asarray(X.sum(axis=0)).ravel()
+        norm_sq += X.multiply(X).sum()
+    mean = column_sum / num_rows
+    total_dist_sq = max(norm_sq - num_rows * mean.dot(mean), 1e-12)
+
+    def inclusion(chunk):
+        X = design.transform(chunk, standardize=True).csr()
+        dist_sq = np.asarray(X.multiply(X).sum(axis=1)).ravel() - 2 * X.dot(mean) + mean.dot(mean)
+        return np.minimum(1., size * (0.5 / num_rows + 0.5 * np.maximum(dist_sq, 0) / total_dist_sq))
+
+    return inclusion
+
+
+def poisson_sample(chunks, inclusion, seed=None):
+    """Keep each row with its inclusion probability p; the rows and their importance weights 1 / p.
+
+    Weighted by 1 / p, the sample estimates sums over all rows without bias (Horvitz-Thompson).
+    """
+    rng = np.random.RandomState(seed)
+    kept = []
+    weights = []
+    for chunk in chunks:
+        p = inclusion(chunk)
+        keep = rng.random_sample(len(chunk)) < p
+        kept.append(chunk[keep])
+        weights.append(1 / p[keep])
+    return pd.concat(kept, ignore_index=True), np.concatenate(weights)
+
+
+def compare_weights(weights, reference, label="Weights vs. reference"):
+    """Report how close two sets of survey weights are (weights are only meaningful up to scale)."""
+    weights = np.asarray(weights, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    rel_diff = np.abs(weights / weights.mean() - reference / reference.mean()) / (reference / reference.mean())
+    print(label + ": pearson r = {0:.4f}; spearman r = {1:.4f}; "
+          "normalized relative difference median = {2:.4f}, 90th percentile = {3:.4f}".format(
+              np.corrcoef(weights, reference)[0, 1],
+              pd.Series(weights).rank().corr(pd.Series(reference).rank()),
+              np.median(rel_diff), np.percentile(rel_diff, 90)))
 
 
 def main():
@@ -26,6 +333,58 @@ def main():
     parser.add_argument("--weighted_response_dir",
                         default=config.weighted_response_dir,
                         help="Folder for output, weighted survey responses")
+    parser.add_argument("--gbc_engine",
+                        default="gbc",
+                        choices=["gbc", "hist"],
+                        help="gbc: GradientBoostingClassifier (single core); "
+                             "hist: multithreaded HistGradientBoostingClassifier with early stopping.")
+    parser.add_argument("--compare_gbc",
+                        action="store_true",
+                        help="With --gbc_engine hist, also fit the original model and report how close the weights are.")
+    parser.add_argument("--design_columns",
+                        default=None,
+                        help="Column vocabulary (json) saved by an earlier run; reuse it instead of fitting "
+                             "one so that the design matrix has identical columns.")
+    parser.add_argument("--cv_folds",
+                        default=0,
+                        type=int,
+                        help="If > 1, weight each row by the out-of-fold score of k cross-fitted models "
+                             "instead of the score of a model fit on all rows.")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=int,
+                        help="Number of processes fitting cross-fitting folds in parallel.")
+    parser.add_argument("--control_sampling",
+                        default="uniform",
+                        choices=["uniform", "stratified", "coreset"],
+                        help="How to reduce the control rows for the batch models. uniform: unweighted random "
+                             "subsample; stratified: subsample stratified by country, host and referer class; "
+                             "coreset: lightweight coreset for the logistic regression (the gradient boosting "
+                             "models, whose weights it does not preserve, get the stratified subsample). The "
+                             "latter two pass importance weights to the models, so the propensity scores "
+                             "approximate a fit on all control rows.")
+    parser.add_argument("--control_ratio",
+                        default=10,
+                        type=int,
+                        help="Control rows per survey row in the reduced control set.")
+    parser.add_argument("--reference_fit",
+                        action="store_true",
+                        help="Also fit the models on all control rows and report how close the weights of "
+                             "the reduced control set are (needs memory for the full control set).")
+    parser.add_argument("--logreg_engine",
+                        default="batch",
+                        choices=["batch", "streaming"],
+                        help="batch: LogisticRegression on the survey rows and the control subsample; "
+                             "streaming: SGD logistic regression over all control rows, one chunk at a time "
+                             "(--cv_folds does not apply).")
+    parser.add_argument("--chunk_size",
+                        default=100000,
+                        type=int,
+                        help="Rows per chunk / scoring batch of the streaming logistic regression.")
+    parser.add_argument("--sgd_epochs",
+                        default=5,
+                        type=int,
+                        help="Passes over the control rows of the streaming logistic regression.")
     args = parser.parse_args()
 
     feature_list = ['host',
@@ -83,36 +442,136 @@ def main():
 
         # Load dataframes with the features
         print("loading data")
-        df_survey = pd.read_pickle(os.path.join(args.featuredf_dir, 'survey_features_{0}.p'.format(lang)))
-        df_sample = pd.read_pickle(os.path.join(args.featuredf_dir, 'sample_features_{0}.p'.format(lang)))
-        if len(df_sample) > (len(df_survey) * 10):
-            df_sample = df_sample.sample(len(df_survey) * 10, replace=False)
-
+        df_survey = read_feature_df(args.featuredf_dir, 'survey', lang)
         # Add column that specifies if row comes from survey answer or random sample
         df_survey['fromSurvey'] = True
-        df_sample['fromSurvey'] = False
+
+        def sample_chunks():
+            return iter_feature_chunks(args.featuredf_dir, 'sample', lang, args.chunk_size)
+
+        # impute numeric features and transform categorical features into binaries (sparse float32)
+        if args.design_columns:
+            design = DesignMatrixBuilder.load(args.design_columns)
+        else:
+            design = DesignMatrixBuilder([f for f in feature_list if f not in features_categorical],
+                                         features_categorical)
+        fit_design = not args.design_columns
+        if args.design_columns:
+            if args.logreg_engine == "streaming":
+                num_sample_rows = sum(len(chunk) for chunk in sample_chunks())
+        elif args.logreg_engine == "streaming" or args.control_sampling == "coreset":
+            print("first pass over the control chunks")
+            num_sample_rows = fit_design_streaming(design, df_survey, sample_chunks)
+            fit_design = False
+
+        # reduce the control rows (read chunk by chunk) to about control_ratio per survey row
+        size = len(df_survey) * args.control_ratio
+
+        def reduce_controls(control_sampling):
+            """Control subsample and its importance weights (None if unweighted)."""
+            if control_sampling == "uniform":
+                df_sample = sample_feature_df(args.featuredf_dir, 'sample', lang, size)
+                control_weight = None
+            else:
+                if control_sampling == "stratified":
+                    inclusion = stratified_inclusion(sample_chunks, size)
+                else:
+                    inclusion = coreset_inclusion(design, sample_chunks, size)
+                df_sample, control_weight = poisson_sample(sample_chunks(), inclusion, seed=0)
+                print("{0} control rows ({1}) with importance weights {2:.1f} to {3:.1f}".format(
+                    len(df_sample), control_sampling, control_weight.min(), control_weight.max()))
+            df_sample['fromSurvey'] = False
+            return df_sample, control_weight
+
+        # the coreset keeps the rows that matter for a linear model; tree models fit on it gave weights
+        # unrelated to a fit on all control rows, so they get a stratified subsample instead
+        gbc_sampling = "stratified" if args.control_sampling == "coreset" else args.control_sampling
+        df_sample, control_weight = reduce_controls(gbc_sampling)
 
         print("preparing data")
         # put both in a single dataframe
         df = pd.concat([df_survey, df_sample], ignore_index=True)
+        if fit_design:
+            design.fit(df)
+        design.save(os.path.join(args.weighted_response_dir, 'design_columns_{0}.json'.format(lang)))
+
+        def batch_weights(df, sample_weight=None, compare_gbc=False, gbc=True, logreg=True):
+            """weights_gbc (if gbc) and weights_logreg (if logreg and not streaming) for all rows of df."""
+            X = design.transform(df)
+            print("design matrix: {0} x {1}, {2:.1f} MB ({3:.1f} MB as dense float64)".format(
+                X.shape[0], X.shape[1], X.nbytes / 1e6, X.shape[0] * X.shape[1] * 8 / 1e6))
+            # Prepare target
+            Y = df['fromSurvey'].astype(int).values
+
+            def weights(engine, X, categorical=None):
+                if args.cv_folds > 1:
+                    work_dir = os.path.join(args.weighted_response_dir, "crossfit_{0}_{1}".format(engine, lang))
+                    return cross_fit_weights(engine, X, Y, work_dir, categorical, args.cv_folds, args.workers,
+                                             sample_weight)
+                return in_sample_weights(engine, X, Y, categorical, sample_weight)
 
-        X = df[feature_list]
-        # transform categorical features into binaries
-        X = pd.get_dummies(X, columns=features_categorical, drop_first=True)
+            weights_gbc = None
+            if gbc:
+                print("Compute gradient boosting weights ({0})".format(args.gbc_engine))
+                start = time.time()
+                if args.gbc_engine == "hist":
+                    X_hist = hist_features(df[feature_list], features_categorical)
+                    weights_gbc = weights("hist", X_hist, [c in features_categorical for c in X_hist.columns])
+                else:
+                    weights_gbc = weights("gbc", X)
+                print("{0:.0f} seconds".format(time.time() - start))
+                if args.gbc_engine == "hist" and compare_gbc:
+                    start = time.time()
+                    reference = weights("gbc", X)
+                    print("reference GradientBoostingClassifier: {0:.0f} seconds".format(time.time() - start))
+                    compare_weights(weights_gbc[Y == 1], reference[Y == 1],
+                                    "weights_gbc, hist vs. GradientBoostingClassifier")
 
-        # Prepare target
-        Y = df['fromSurvey'].astype(int)
+            weights_logreg = None
+            if logreg and args.logreg_engine == "batch":
+                print("Compute logistic regression weights (batch)")
+                start = time.time()
+                weights_logreg = weights("logreg", X)
+                print("{0:.0f} seconds".format(time.time() - start))
+            return weights_gbc, weights_logreg
 
-        print("Compute gradient boosting weights")
-        model = Pipeline([("imputer", Imputer()),
-                          ("clsfr", GradientBoostingClassifier(n_estimators=500, verbose=1))])
-        model.fit(X, Y)
-        df['weights_gbc'] = 1 / model.predict_proba(X)[:, 1]
+        sample_weight = None
+        if control_weight is not None:
+            sample_weight = np.r_[np.ones(len(df_survey)), control_weight]
+        df['weights_gbc'], weights_logreg = batch_weights(df, sample_weight, args.compare_gbc,
+                                                          logreg=args.control_sampling != "coreset")
+        logreg_sample = "{0} control rows ({1})".format(len(df_sample), gbc_sampling)
+        if args.logreg_engine == "batch" and args.control_sampling == "coreset":
+            df_coreset, coreset_weight = reduce_controls("coreset")
+            logreg_sample = "{0} control rows (coreset)".format(len(df_coreset))
+            _, weights_logreg = batch_weights(pd.concat([df_survey, df_coreset], ignore_index=True),
+                                              np.r_[np.ones(len(df_survey)), coreset_weight], gbc=False)
+            df.loc[df['fromSurvey'], 'weights_logreg'] = weights_logreg[:len(df_survey)]
+            del df_coreset
+        elif args.logreg_engine == "streaming":
+            print("Compute logistic regression weights (streaming)")
+            weights_logreg = streaming_logreg_weights(design, df_survey, sample_chunks, num_sample_rows,
+                                                      args.sgd_epochs, args.chunk_size)
+            check_streaming_logreg(design, df_survey, df_sample, control_weight, num_sample_rows, weights_logreg)
+            df.loc[df['fromSurvey'], 'weights_logreg'] = weights_logreg
+        else:
+            df['weights_logreg'] = weights_logreg
 
-        print("Compute logistic regression weights")
-        model = Pipeline([("imputer", Imputer()), ("clsfr", LogisticRegression())])
-        model.fit(X, Y)
-        df['weights_logreg'] = 1 / model.predict_proba(X)[:, 1]
+        if args.reference_fit:
+            print("Reference fit on all control rows")
+            df_full = read_feature_df(args.featuredf_dir, 'sample', lang)
+            df_full['fromSurvey'] = False
+            df_full = pd.concat([df_survey, df_full], ignore_index=True)
+            reference_gbc, reference_logreg = batch_weights(df_full)
+            survey = df['fromSurvey'].values
+            num_full = len(df_full) - len(df_survey)
+            compare_weights(df['weights_gbc'].values[survey], reference_gbc[:len(df_survey)],
+                            "weights_gbc, {0} control rows ({1}) vs. all {2}".format(
+                                len(df_sample), gbc_sampling, num_full))
+            if reference_logreg is not None:
+                compare_weights(df['weights_logreg'].values[survey], reference_logreg[:len(df_survey)],
+                                "weights_logreg, {0} vs. all {1}".format(logreg_sample, num_full))
+            del df_full
 
         print("writing weighted file (survey_samples)")
         df = df[df['fromSurvey'] == True]
@@ -3,5 +3,25 @@ from .utils import exec_mariadb_stat2
 from .utils import user_hash
 from .utils import download_dump_file
 from .utils import read_redirects
+from .articles import article_store_dir
+from .articles import ArticleStore
+from .articles import check_article_store
+from .articles import load_article_store
+from .articles import save_article_store
+from .features import feature_df_fn
+from .features import iter_feature_chunks
+from .features import read_feature_df
+from .features import sample_feature_df
+from .features import write_feature_df
+from .geo import GeoDecoder
+from .redirects import build_redirect_index
+from .redirects import load_redirect_index
+from .redirects import RedirectIndex
+from .geo import parse_hive_map
+from .sqldump import iter_sql_rows
+from .sqldump import sql_columns
+from .traces import Trace
+from .traces import TraceTable
+from .traces import TraceTableBuilder
 
 from .config import *
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""Memory-mapped article feature store written by 01_get_article_data.py and read by 02_feature_construction.py.
+
+The store is a directory of .npy arrays (all in the hash order of the titles):
+ * hashes / title_offsets / title_blob: PackedStringIndex over the lowercased article titles
+ * page_id: int64 page ids
+ * one float32 array per entry of ARTICLE_COLUMNS (NaN if unknown)
+ * topics: float32 matrix of LDA topic proportions (articles x topics)
+Opening the store only maps the files, so any number of worker processes share one copy.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from .packed import PackedStringIndex
+
+STORE_VERSION = 1
+ARTICLE_COLUMNS = ('page_length', 'weekly_pageviews', 'pagerank', 'indegree', 'outdegree')
+TITLE_ARRAYS = ('hashes', 'title_offsets', 'title_blob')
+
+
+def article_store_dir(article_dir, lang):
+    return os.path.join(article_dir, "article_features_{0}".format(lang))
+
+
+def save_article_store(store_dir, titles, page_ids, columns, topics):
+    """Write the store. `columns` maps each of ARTICLE_COLUMNS to values aligned with `titles`.
+
+    Only articles of the focal language (integer page ids) are stored; other languages' pages are
+    keyed "lang:pid" and have no features. Titles are lowercased; if several articles share a
+    lowercased title, the one with the fewest missing features is kept (the first one on ties).
+    """
+    titles = pd.Series(titles)
+    has_title = titles.notnull().values
+    titles = titles.astype(str).str.lower().values
+    page_ids = pd.Series(page_ids).values
+    focal = np.array([isinstance(pid, (int, np.integer)) for pid in page_ids], dtype=bool)
+    topics = np.asarray(topics, dtype=np.float32)
+    values = {c: np.asarray(columns[c], dtype=np.float32) for c in ARTICLE_COLUMNS}
+    num_missing = sum(np.isnan(v) for v in values.values()) + np.isnan(topics).sum(axis=1)
+    candidates = np.flatnonzero(focal & has_title)
+    candidates = candidates[np.argsort(num_missing[candidates], kind='stable')]
+    keep = candidates[~pd.Series(titles[candidates]).duplicated().values]
+    print("{0} of {1} pages are not in the focal language; {2} duplicate titles dropped.".format(
+        int((~focal).sum()), len(titles), len(candidates) - len(keep)))
+    title_index, order = PackedStringIndex.build(list(titles[keep]))
+    rows = keep[order]
+    arrays = {'hashes': title_index.hashes,
+              'title_offsets': title_index.offsets,
+              'title_blob': title_index.blob,
+              'page_id': page_ids[rows].astype(np.int64),
+              'topics': topics[rows]}
+    for c in ARTICLE_COLUMNS:
+        arrays[c] = values[c][rows]
+
+    # write to a temporary directory and swap so readers never see a partial store
+    tmp_dir = store_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), values)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as fout:
+        json.dump({'version': STORE_VERSION, 'size': len(rows), 'num_topics': arrays['topics'].shape[1]}, fout)
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+    print("{0} articles written to {1}".format(len(rows), store_dir))
+    return store_dir
+
+
+def load_article_store(store_dir):
+    """Memory-map an article feature store."""
+    with open(os.path.join(store_dir, "meta.json"), 'r') as fin:
+        meta = json.load(fin)
+    if meta['version'] != STORE_VERSION:
+        raise ValueError("Article store {0} has version {1}; expected {2}. Rerun 01_get_article_data.py.".format(
+            store_dir, meta['version'], STORE_VERSION))
+    names = TITLE_ARRAYS + ('page_id', 'topics') + ARTICLE_COLUMNS
+    return ArticleStore({name: np.load(os.path.join(store_dir, name + ".npy"), mmap_mode='r') for name in names})
+
+
+class ArticleStore:
+    """Read-only article features looked up by (case-insensitive) title."""
+
+    def __init__(self, arrays):
+        self.titles = PackedStringIndex(arrays['hashes'], arrays['title_offsets'], arrays['title_blob'])
+        self.page_id = arrays['page_id']
+        self.topics = arrays['topics']
+        self.columns = {c: arrays[c] for c in ARTICLE_COLUMNS}
+
+    def __len__(self):
+        return len(self.page_id)
+
+    @property
+    def num_topics(self):
+        return self.topics.shape[1]
+
+    def find(self, titles):
+        """Row of each title in the store (-1 if unknown)."""
+        return self.titles.find([t.lower() for t in titles])
+
+    def column(self, name, rows):
+        """Values of a column for `rows` (NaN where the row is -1)."""
+        values = np.full(len(rows), np.nan, dtype=np.float32)
+        found = rows >= 0
+        values[found] = self.columns[name][rows[found]]
+        return values
+
+    def topic_matrix(self, rows):
+        """Topic proportions for `rows` (NaN rows where the row is -1)."""
+        values = np.full((len(rows), self.num_topics), np.nan, dtype=np.float32)
+        found = rows >= 0
+        values[found] = self.topics[rows[found]]
+        return values
+
+    def to_frame(self, rows, index=None):
+        """DataFrame of all features for `rows` with topic columns named topic_0, topic_1, ..."""
+        df = pd.DataFrame({c: self.column(c, rows) for c in ARTICLE_COLUMNS}, index=index)
+        topics = self.topic_matrix(rows)
+        for i in range(self.num_topics):
+            df["topic_{0}".format(i)] = topics[:, i]
+        return df
+
+
+def check_article_store(store_dir, df, title_column, topic_columns, sample_size=10000, seed=0):
+    """Check title lookups in the store against `.loc` on the page-id indexed DataFrame it was built from.
+
+    For a sample of focal-language rows, the lowercased title must be found and the stored features
+    must equal those of the page id the store returns. Raises ValueError on mismatches.
+    """
+    store = load_article_store(store_dir)
+    focal = np.array([isinstance(pid, (int, np.integer)) for pid in df.index], dtype=bool)
+    focal = df[focal & df[title_column].notnull().values]
+    sample = focal.sample(min(sample_size, len(focal)), random_state=seed)
+    rows = store.find(sample[title_column].astype(str).tolist())
+    missing = int((rows < 0).sum())
+    found = rows >= 0
+    reference = df.loc[store.page_id[rows[found]]]
+    expected = reference[list(ARTICLE_COLUMNS) + list(topic_columns)].values.astype(np.float32)
+    actual = np.column_stack([np.column_stack([store.column(c, rows[found]) for c in ARTICLE_COLUMNS]),
+                              store.topic_matrix(rows[found])])
+    wrong_title = int((reference[title_column].astype(str).str.lower().values
+                       != sample[title_column].astype(str).str.lower().values[found]).sum())
+    wrong_values = int((~np.isclose(actual, expected, equal_nan=True)).any(axis=1).sum())
+    print("Article store check: {0} titles; {1} not found, {2} with another title, {3} with other values.".format(
+        len(sample), missing, wrong_title, wrong_values))
+    if missing or wrong_title or wrong_values:
+        raise ValueError("Article store {0} does not match the article table.".format(store_dir))
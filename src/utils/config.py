@@ -56,6 +56,8 @@ lda_max_features = 100000 # keep only top k terms
 
 # pageviews folder
 pageviews_folder = os.path.join(data_folder, "pageviews")
+# daily user-agent pageview dumps (pageview_complete pageviews-YYYYMMDD-user.bz2) for the survey period
+pageview_dumps_folder = os.path.join(pageviews_folder, "user")
 
 # folder containing final survey responses with weights
 weighted_response_dir = os.path.join(data_folder, "weighted_responses")
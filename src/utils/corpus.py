@@ -0,0 +1,175 @@
+"""Bounded-memory tf-idf corpus for topic modeling over a whole Wikipedia dump.
+
+Mirrors TfidfVectorizer(max_df, min_df, max_features) with the default analyzer, idf and l2
+normalization, but never holds the corpus in memory:
+ * fit() tokenizes every text once, counting document and term frequencies, and writes the raw
+   term counts of each document to disk in chunks (.npz files of CSR pieces)
+ * the vocabulary is then selected with the same min_df / max_df / max_features rules
+ * iterating the corpus streams the chunks back as gensim bag-of-words tf-idf vectors
+Only the term -> id dictionary (one entry per distinct token) grows with the wiki.
+"""
+from array import array
+from collections import Counter
+import json
+import os
+import shutil
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+CORPUS_VERSION = 1
+
+
+class StreamingTfidfCorpus:
+    """Re-iterable gensim corpus of tf-idf vectors, stored as chunks in `corpus_dir`."""
+
+    def __init__(self, corpus_dir, max_df=1.0, min_df=1, max_features=None, chunk_size=10000):
+        self.corpus_dir = corpus_dir
+        self.max_df = max_df
+        self.min_df = min_df
+        self.max_features = max_features
+        self.chunk_size = chunk_size
+        self.num_docs = 0
+        self.num_chunks = 0
+        self.vocabulary = []
+        self.idf = None
+        self.term_map = None
+
+    def __len__(self):
+        return self.num_docs
+
+    @property
+    def id2word(self):
+        return dict(enumerate(self.vocabulary))
+
+    def fit(self, texts):
+        """Tokenize `texts` (any iterable, consumed once), write the raw counts and select the vocabulary."""
+        if os.path.isdir(self.corpus_dir):
+            shutil.rmtree(self.corpus_dir)
+        os.makedirs(self.corpus_dir)
+        analyzer = TfidfVectorizer().build_analyzer()
+        term_ids = {}
+        doc_freq = array('q')
+        term_freq = array('q')
+        chunk = ChunkWriter(self)
+        for text in texts:
+            counts = Counter()
+            for term in analyzer(text):
+                tid = term_ids.get(term)
+                if tid is None:
+                    tid = term_ids[term] = len(term_ids)
+                    doc_freq.append(0)
+                    term_freq.append(0)
+                counts[tid] += 1
+            for tid, count in counts.items():
+                doc_freq[tid] += 1
+                term_freq[tid] += count
+            chunk.add(counts)
+            self.num_docs += 1
+        chunk.flush()
+
+        terms = np.empty(len(term_ids), dtype=object)
+        for term, tid in term_ids.items():
+            terms[tid] = term
+        del term_ids
+        self._select_vocabulary(terms, np.frombuffer(doc_freq, dtype=np.int64), np.frombuffer(term_freq, dtype=np.int64))
+        self._save_meta()
+        print("{0} documents in {1} chunks; {2} of {3} terms kept.".format(
+            self.num_docs, self.num_chunks, len(self.vocabulary), len(terms)))
+        return self
+
+    def _select_vocabulary(self, terms, doc_freq, term_freq):
+        """Same rules as sklearn's CountVectorizer._limit_features (ties broken alphabetically)."""
+        max_doc_count = self.max_df if isinstance(self.max_df, int) else self.max_df * self.num_docs
+        min_doc_count = self.min_df if isinstance(self.min_df, int) else self.min_df * self.num_docs
+        if max_doc_count < min_doc_count:
+            raise ValueError("max_df corresponds to < documents than min_df")
+        alphabetical = np.array(sorted(range(len(terms)), key=terms.__getitem__), dtype=np.int64)
+        kept = alphabetical[(doc_freq[alphabetical] <= max_doc_count) & (doc_freq[alphabetical] >= min_doc_count)]
+        if self.max_features is not None and len(kept) > self.max_features:
+            # most frequent terms over the corpus, back in alphabetical order
+            top = np.sort(np.argsort(-term_freq[kept], kind='stable')[:self.max_features])
+            kept = kept[top]
+        self.vocabulary = list(terms[kept])
+        self.term_map = np.full(len(terms), -1, dtype=np.int32)
+        self.term_map[kept] = np.arange(len(kept), dtype=np.int32)
+        # smooth_idf=True
+        self.idf = np.log((1. + self.num_docs) / (1. + doc_freq[kept])) + 1.
+
+    def _save_meta(self):
+        np.save(os.path.join(self.corpus_dir, "term_map.npy"), self.term_map)
+        np.save(os.path.join(self.corpus_dir, "idf.npy"), self.idf)
+        with open(os.path.join(self.corpus_dir, "vocabulary.txt"), 'w') as fout:
+            for term in self.vocabulary:
+                fout.write(term + "\n")
+        with open(os.path.join(self.corpus_dir, "meta.json"), 'w') as fout:
+            json.dump({'version': CORPUS_VERSION, 'num_docs': self.num_docs, 'num_chunks': self.num_chunks}, fout)
+
+    @classmethod
+    def load(cls, corpus_dir):
+        """Reopen a fitted corpus (e.g., to re-run inference without tokenizing the dump again)."""
+        with open(os.path.join(corpus_dir, "meta.json"), 'r') as fin:
+            meta = json.load(fin)
+        if meta['version'] != CORPUS_VERSION:
+            raise ValueError("Corpus {0} has version {1}; expected {2}.".format(corpus_dir, meta['version'], CORPUS_VERSION))
+        corpus = cls(corpus_dir)
+        corpus.num_docs = meta['num_docs']
+        corpus.num_chunks = meta['num_chunks']
+        corpus.term_map = np.load(os.path.join(corpus_dir, "term_map.npy"))
+        corpus.idf = np.load(os.path.join(corpus_dir, "idf.npy"))
+        with open(os.path.join(corpus_dir, "vocabulary.txt"), 'r') as fin:
+            corpus.vocabulary = [line.rstrip("\n") for line in fin]
+        return corpus
+
+    def to_vectorizer(self):
+        """TfidfVectorizer with this corpus' vocabulary and idf (e.g., to vectorize new texts for inference)."""
+        vectorizer = TfidfVectorizer(vocabulary={t: i for i, t in enumerate(self.vocabulary)})
+        vectorizer.idf_ = self.idf
+        return vectorizer
+
+    def chunk_fn(self, i):
+        return os.path.join(self.corpus_dir, "chunk_{0:06d}.npz".format(i))
+
+    def __iter__(self):
+        """Yield each document as a list of (term id, l2-normalized tf-idf weight)."""
+        for i in range(self.num_chunks):
+            with np.load(self.chunk_fn(i)) as chunk:
+                indptr, term_ids, counts = chunk['indptr'], chunk['term_ids'], chunk['counts']
+            ids = self.term_map[term_ids]
+            weights = np.where(ids >= 0, counts * self.idf[np.maximum(ids, 0)], 0.)
+            doc = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            norms = np.sqrt(np.bincount(doc, weights=weights ** 2, minlength=len(indptr) - 1))
+            weights = weights / np.where(norms > 0, norms, 1.)[doc]
+            for start, end in zip(indptr[:-1], indptr[1:]):
+                keep = ids[start:end] >= 0
+                yield list(zip(ids[start:end][keep].tolist(), weights[start:end][keep].tolist()))
+
+
+class ChunkWriter:
+    """Buffer raw term counts of documents and write them as one .npz per `chunk_size` documents."""
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self._reset()
+
+    def _reset(self):
+        self.indptr = array('q', [0])
+        self.term_ids = array('i')
+        self.counts = array('i')
+
+    def add(self, counts):
+        self.term_ids.extend(counts.keys())
+        self.counts.extend(counts.values())
+        self.indptr.append(len(self.term_ids))
+        if len(self.indptr) > self.corpus.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.indptr) == 1:
+            return
+        np.savez(self.corpus.chunk_fn(self.corpus.num_chunks),
+                 indptr=np.frombuffer(self.indptr, dtype=np.int64),
+                 term_ids=np.frombuffer(self.term_ids, dtype=np.int32),
+                 counts=np.frombuffer(self.counts, dtype=np.int32))
+        self.corpus.num_chunks += 1
+        self._reset()
@@ -0,0 +1,139 @@
+"""Compact design matrix for the propensity models of 04_propensity_weighting.py.
+
+Replaces `pd.get_dummies(drop_first=True)` followed by mean imputation in each model pipeline:
+ * numeric features are mean-imputed once and stored as a dense float32 block
+ * categorical features are one-hot encoded (first category dropped, missing values get no column)
+   into a float32 CSR block, so the dummies of high-cardinality columns like country_code cost one
+   entry per row instead of one dense column per category
+Each model is given the format it fits best (see DesignMatrix.dense / DesignMatrix.csr).
+The fitted column vocabulary (categories, imputation means and standard deviations) is saved as json
+so that a later scoring run produces exactly the same columns; categories unseen at fit time get no
+column. fit_chunks() computes the same vocabulary in one pass over DataFrame chunks, for data that
+does not fit in memory.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+DESIGN_VERSION = 2
+
+
+class DesignMatrixBuilder:
+
+    def __init__(self, numeric, categorical, drop_first=True):
+        self.numeric = list(numeric)
+        self.categorical = list(categorical)
+        self.drop_first = drop_first
+        self.means = None
+        self.stds = None
+        self.categories = None
+
+    def fit(self, df):
+        """Imputation means / standard deviations of the numeric and (sorted) categories of the categorical features."""
+        return self.fit_chunks([df])
+
+    def fit_chunks(self, chunks):
+        """Like fit, in one pass over an iterable of DataFrames."""
+        num_rows = 0
+        count = np.zeros(len(self.numeric))
+        total = np.zeros(len(self.numeric))
+        total_sq = np.zeros(len(self.numeric))
+        categories = {c: set() for c in self.categorical}
+        for df in chunks:
+            num_rows += len(df)
+            for i, c in enumerate(self.numeric):
+                values = df[c].astype(np.float64).values
+                values = values[~np.isnan(values)]
+                count[i] += len(values)
+                total[i] += values.sum()
+                total_sq[i] += (values ** 2).sum()
+            for c in self.categorical:
+                categories[c].update(str(v) for v in df[c].dropna().unique())
+        means = total / np.maximum(count, 1)
+        # variance after imputing the mean for missing values
+        stds = np.sqrt(np.maximum(total_sq - count * means ** 2, 0) / max(num_rows, 1))
+        self.means = means.tolist()
+        self.stds = np.where(stds > 0, stds, 1.).tolist()
+        self.categories = {}
+        for c in self.categorical:
+            values = sorted(categories[c])
+            self.categories[c] = values[1:] if self.drop_first else values
+        return self
+
+    @property
+    def columns(self):
+        return self.numeric + ["{0}_{1}".format(c, v) for c in self.categorical for v in self.categories[c]]
+
+    def transform(self, df, standardize=False):
+        """DesignMatrix with the columns of self.columns (numeric columns scaled to mean 0 / std 1 if standardize)."""
+        numeric = np.empty((len(df), len(self.numeric)), dtype=np.float32)
+        for i, (c, mean, std) in enumerate(zip(self.numeric, self.means, self.stds)):
+            values = df[c].astype(np.float64).values
+            values = np.where(np.isnan(values), mean, values)
+            numeric[:, i] = (values - mean) / std if standardize else values
+        blocks = []
+        for c in self.categorical:
+            categories = self.categories[c]
+            codes = pd.Categorical(df[c].astype(str).where(df[c].notnull()).values, categories=categories).codes
+            rows = np.flatnonzero(codes >= 0)
+            blocks.append(sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, codes[rows])),
+                                            shape=(len(df), len(categories))))
+        if blocks:
+            onehot = sparse.hstack(blocks, format='csr', dtype=np.float32)
+        else:
+            onehot = sparse.csr_matrix((len(df), 0), dtype=np.float32)
+        return DesignMatrix(numeric, onehot)
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def save(self, fn):
+        with open(fn, 'w') as fout:
+            json.dump({'version': DESIGN_VERSION, 'numeric': self.numeric, 'categorical': self.categorical,
+                       'drop_first': self.drop_first, 'means': self.means, 'stds': self.stds,
+                       'categories': self.categories}, fout)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'r') as fin:
+            meta = json.load(fin)
+        if meta['version'] != DESIGN_VERSION:
+            raise ValueError("Design columns {0} have version {1}; expected {2}.".format(
+                fn, meta['version'], DESIGN_VERSION))
+        builder = cls(meta['numeric'], meta['categorical'], meta['drop_first'])
+        builder.means = meta['means']
+        builder.stds = meta['stds']
+        builder.categories = meta['categories']
+        return builder
+
+
+class DesignMatrix:
+    """Numeric features (dense float32) next to the one-hot categoricals (float32 CSR)."""
+
+    def __init__(self, numeric, onehot):
+        self.numeric = numeric
+        self.onehot = onehot
+
+    def __len__(self):
+        return self.numeric.shape[0]
+
+    @property
+    def shape(self):
+        return self.numeric.shape[0], self.numeric.shape[1] + self.onehot.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.numeric.nbytes + self.onehot.data.nbytes + self.onehot.indices.nbytes + self.onehot.indptr.nbytes
+
+    def rows(self, index):
+        return DesignMatrix(self.numeric[index], self.onehot[index])
+
+    def dense(self):
+        """float32 array, e.g., for tree models (which would convert a sparse matrix to dense columns anyway)."""
+        return np.hstack([self.numeric, self.onehot.toarray()])
+
+    def csr(self):
+        """float32 CSR matrix, e.g., for linear models."""
+        return sparse.hstack([sparse.csr_matrix(self.numeric), self.onehot], format='csr', dtype=np.float32)
@@ -0,0 +1,61 @@
+"""Pickled feature DataFrames in feature_dfs, optionally split into chunk files.
+
+02_feature_construction.py writes `{name}_features_{lang}.p` (name: survey / sample) or, with a chunk
+size, `{name}_features_{lang}_0000.p`, `{name}_features_{lang}_0001.p`, ... so that consumers like the
+streaming propensity model only ever hold one chunk in memory.
+"""
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def feature_df_fn(featuredf_dir, name, lang):
+    return os.path.join(featuredf_dir, "{0}_features_{1}.p".format(name, lang))
+
+
+def feature_chunk_fns(featuredf_dir, name, lang):
+    """Chunk files (in order) if there are any, otherwise the single pickle."""
+    fns = sorted(glob.glob(os.path.join(featuredf_dir, "{0}_features_{1}_[0-9][0-9][0-9][0-9].p".format(name, lang))))
+    return fns or [feature_df_fn(featuredf_dir, name, lang)]
+
+
+def write_feature_df(df, featuredf_dir, name, lang, chunk_size=0):
+    """Pickle `df` as a single file or (chunk_size > 0) as chunk files, removing files of earlier runs."""
+    for fn in feature_chunk_fns(featuredf_dir, name, lang):
+        if os.path.exists(fn):
+            os.remove(fn)
+    if chunk_size <= 0:
+        df.to_pickle(feature_df_fn(featuredf_dir, name, lang))
+        return
+    for i, start in enumerate(range(0, len(df), chunk_size)):
+        df.iloc[start:start + chunk_size].to_pickle(
+            os.path.join(featuredf_dir, "{0}_features_{1}_{2:04d}.p".format(name, lang, i)))
+
+
+def iter_feature_chunks(featuredf_dir, name, lang, chunk_size=100000):
+    """Yield the feature DataFrame in pieces of at most chunk_size rows (one file in memory at a time)."""
+    for fn in feature_chunk_fns(featuredf_dir, name, lang):
+        df = pd.read_pickle(fn)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+
+
+def read_feature_df(featuredf_dir, name, lang):
+    return pd.concat([pd.read_pickle(fn) for fn in feature_chunk_fns(featuredf_dir, name, lang)], ignore_index=True)
+
+
+def sample_feature_df(featuredf_dir, name, lang, size, seed=None):
+    """Uniform random sample of `size` rows (all rows if fewer) without loading all chunks at once.
+
+    Every row gets a random key and the rows with the `size` smallest keys are kept chunk by chunk.
+    """
+    rng = np.random.RandomState(seed)
+    kept = None
+    for fn in feature_chunk_fns(featuredf_dir, name, lang):
+        df = pd.read_pickle(fn)
+        df = df.assign(_sample_key=rng.random_sample(len(df)))
+        kept = df if kept is None else pd.concat([kept, df])
+        kept = kept.nsmallest(size, '_sample_key')
+    return kept.drop(columns='_sample_key').reset_index(drop=True)
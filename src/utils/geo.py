@@ -0,0 +1,61 @@
+"""Decoding of the Hive `geocoded_data` map that accompanies every trace line."""
+import ast
+import json
+
+import pandas as pd
+
+
+def parse_hive_map(literal):
+    """Parse a Hive MAP<STRING,STRING> as printed by the Hive CLI (JSON-like) without eval().
+
+    Falls back to a Python literal (single-quoted) representation but never executes code.
+    """
+    try:
+        decoded = json.loads(literal)
+    except ValueError:
+        decoded = ast.literal_eval(literal)
+    if not isinstance(decoded, dict):
+        raise ValueError("Not a map literal: {0}".format(literal[:100]))
+    return {str(k): (None if v is None else str(v)) for k, v in decoded.items()}
+
+
+class GeoDecoder:
+    """Decode geocoded_data strings, interning the (few thousand) distinct records.
+
+    Identical strings -- and strings that decode to the same map -- share one geo id
+    and one dict object. The distinct records can then be joined back onto a DataFrame
+    with `to_frame` instead of expanding every row with `apply`.
+    """
+
+    def __init__(self):
+        self._by_literal = {}
+        self._by_record = {}
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def decode(self, literal):
+        """Geo id for a map literal."""
+        geo_id = self._by_literal.get(literal)
+        if geo_id is None:
+            geo_id = self._by_literal[literal] = self.add(parse_hive_map(literal))
+        return geo_id
+
+    def add(self, record):
+        """Geo id for an already decoded record."""
+        key = tuple(sorted(record.items()))
+        geo_id = self._by_record.get(key)
+        if geo_id is None:
+            geo_id = self._by_record[key] = len(self.records)
+            self.records.append(record)
+        return geo_id
+
+    def merge(self, records):
+        """Intern records of another decoder (e.g., from a worker process); returns their new geo ids."""
+        return [self.add(r) for r in records]
+
+    def to_frame(self, columns):
+        """DataFrame of the distinct records indexed by geo id (missing keys are None)."""
+        return pd.DataFrame([[r.get(c, None) for c in columns] for r in self.records],
+                            columns=columns).rename_axis('geo_id')
@@ -0,0 +1,333 @@
+"""Batch matching of IP geolocations (country, city, lat, lon) to Geonames populations.
+
+Status codes returned in place of a population follow the original row-wise lookup:
+ * >= 0: population of the best match (0 if Geonames lists 0)
+ * -1: matching place found but Geonames does not give a population
+ * -2: city name matched but no candidate within the distance threshold (and no populated place nearby)
+ * -3: no name match and no populated place within the distance threshold
+
+The parsed Geonames dump is compiled once into a GeonamesIndex that is saved next to the
+source TSV as .npy arrays and memory-mapped on later runs (see load_geonames_index).
+"""
+import csv
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+from .packed import PackedStringIndex
+
+EARTH_RADIUS_KM = 6371.0088
+
+# bump whenever the parsing / index layout changes so old artifacts are rebuilt
+GEONAMES_INDEX_VERSION = 1
+INDEX_ARRAYS = ('lat', 'lon', 'population', 'key_hashes', 'key_str_offsets', 'key_blob', 'key_offsets', 'key_places')
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between arrays of points given in degrees."""
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def place_key(country, name):
+    return "{0}\t{1}".format(country, name)
+
+
+class GeonamesIndex:
+    """Columnar Geonames lookup.
+
+     * lat / lon / population: one row per distinct (point, population) place
+     * keys: (country, name) strings; key_offsets / key_places list the places for each key
+    A BallTree (haversine metric) over the places with population > 0 answers
+    "nearest populated place" queries. `build_id` identifies the Geonames file it was built from.
+    """
+
+    def __init__(self, lat, lon, population, keys, key_offsets, key_places, build_id=None):
+        self.build_id = build_id
+        self.lat = lat
+        self.lon = lon
+        self.population = population
+        self.keys = keys
+        self.key_offsets = key_offsets
+        self.key_places = key_places
+        self._populated = None
+        self._tree = None
+
+    def __len__(self):
+        return len(self.lat)
+
+    def nearest_populated(self, lats, lons, dist_threshold):
+        """Population of the nearest place with population > 0 within dist_threshold km (-3 if none)."""
+        if self._tree is None:
+            self._populated = np.flatnonzero(self.population > 0)
+            self._tree = BallTree(np.radians(np.column_stack([self.lat[self._populated], self.lon[self._populated]])),
+                                  metric='haversine')
+        pops = np.full(len(lats), -3, dtype=np.int64)
+        valid = ~(np.isnan(lats) | np.isnan(lons))
+        if valid.any() and len(self._populated):
+            dist, idx = self._tree.query(np.radians(np.column_stack([lats[valid], lons[valid]])), k=1)
+            within = dist[:, 0] * EARTH_RADIUS_KM < dist_threshold
+            rows = np.flatnonzero(valid)[within]
+            pops[rows] = self.population[self._populated[idx[within, 0]]]
+        return pops
+
+    def name_matches(self, countries, cities, lats, lons, dist_threshold):
+        """Match rows on (country, city) name.
+
+        Returns (has_key, matched, best): whether the name is known, whether any place with that name
+        lies within dist_threshold km, and the max population among those places.
+        """
+        key_pos = self.keys.find([place_key(c, n) for c, n in zip(countries, cities)])
+        has_key = key_pos >= 0
+        rows = np.flatnonzero(has_key)
+        starts = self.key_offsets[key_pos[rows]]
+        counts = self.key_offsets[key_pos[rows] + 1] - starts
+        # expand to one (row, candidate place) pair per candidate
+        pair_rows = np.repeat(rows, counts)
+        within_key = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_places = self.key_places[np.repeat(starts, counts) + within_key]
+        dist = haversine_km(lats[pair_rows], lons[pair_rows], self.lat[pair_places], self.lon[pair_places])
+        close = dist < dist_threshold
+        best = np.full(len(key_pos), np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(best, pair_rows[close], self.population[pair_places[close]])
+        matched = best != np.iinfo(np.int64).min
+        return has_key, matched, best
+
+
+def get_geonames_map(allcountries):
+    geonames_header = ['geonameid', 'name', 'asciiname', 'alternatenames',
+                       'latitude', 'longitude', 'feature class', 'feature code',
+                       'country code', 'cc2', 'admin1 code', 'admin2 code', 'admin3 code', 'admin4 code',
+                       'population', 'elevation', 'dem', 'timezone', 'modification date']
+    country_idx = geonames_header.index('country code')
+    pop_idx = geonames_header.index('population')
+    lat_idx = geonames_header.index('latitude')
+    lon_idx = geonames_header.index('longitude')
+    name_idx = geonames_header.index('name')
+    altname_idx = geonames_header.index('alternatenames')
+    feature_idx = geonames_header.index('feature class')
+
+    lookup = {}
+    num_countries = 0
+    num_places = 0
+    num_pops = 0
+    nonzero_pops = 0
+    duplicates = 0
+    with open(allcountries, 'r') as fin:
+        tsvreader = csv.reader(fin, delimiter='\t')
+        for line in tsvreader:
+            feature = line[feature_idx]
+            try:
+                population = int(line[pop_idx])
+            except ValueError:
+                population = -1
+            if (feature == 'A' and population >= 0) or feature == 'P':
+                pt = (float(line[lat_idx]), float(line[lon_idx]))
+                names = [line[name_idx]]
+                if line[altname_idx]:
+                    names.extend(line[altname_idx].split(','))
+                country = line[country_idx]
+                if country not in lookup:
+                    num_countries += 1
+                    lookup[country] = {}
+                for n in names:
+                    if n in lookup[country]:
+                        if pt in lookup[country][n]:
+                            existing_pop = lookup[country][n][pt]
+                            if not population:
+                                continue
+                            elif existing_pop == population:
+                                continue
+                            elif not existing_pop:
+                                lookup[country][n][pt] = population
+                                num_pops += 1
+                            else:
+                                duplicates += 1
+                        else:
+                            lookup[country][n][pt] = population
+                            num_places += 1
+                            if num_places % 500000 == 0:
+                                print(num_places, "added.")
+                            if population >= 0:
+                                num_pops += 1
+                                if population == 0:
+                                    nonzero_pops += 1
+                    else:
+                        lookup[country][n] = {pt:population}
+                        num_places += 1
+                        if num_places % 500000 == 0:
+                            print(num_places, "added.")
+                        if population >= 0:
+                            num_pops += 1
+                            if population == 0:
+                                nonzero_pops += 1
+    print("{0} countries. {1} places. {2} places w/ population. {3} w/ pop 0. {4} duplicates".format(
+        num_countries, num_places, num_pops, nonzero_pops, duplicates))
+    return lookup
+
+
+def build_geonames_index(lookup):
+    """Convert the nested {country: {name: {(lat, lon): population}}} lookup into a GeonamesIndex."""
+    place_ids = {}
+    keys = []
+    key_places = []
+    for country, names in lookup.items():
+        for name, places in names.items():
+            ids = []
+            for pt, pop in places.items():
+                place = (pt[0], pt[1], pop)
+                pid = place_ids.get(place)
+                if pid is None:
+                    pid = place_ids[place] = len(place_ids)
+                ids.append(pid)
+            keys.append(place_key(country, name))
+            key_places.append(ids)
+    return _index_from_lists(place_ids, keys, key_places)
+
+
+def _index_from_lists(place_ids, keys, key_places):
+    places = np.array(list(place_ids), dtype=np.float64).reshape(-1, 3)
+    key_index, order = PackedStringIndex.build(keys)
+    key_places = [key_places[i] for i in order]
+    key_offsets = np.zeros(len(key_places) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in key_places], out=key_offsets[1:])
+    flat_places = np.array([p for ps in key_places for p in ps], dtype=np.int32)
+    return GeonamesIndex(lat=places[:, 0].copy(), lon=places[:, 1].copy(), population=places[:, 2].astype(np.int64),
+                         keys=key_index, key_offsets=key_offsets, key_places=flat_places)
+
+
+def lookup_populations(index, countries, cities, lats, lons, dist_threshold):
+    """Vectorized IP -> population matching for whole columns (see module docstring for status codes).
+
+    If the city is known, the most populous Geonames place with that name within dist_threshold
+    is used; otherwise (or if no candidate is close enough) the nearest populated place within
+    dist_threshold.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    cities = [c if isinstance(c, str) else '' for c in cities]
+    unknown = np.array([c.lower() == 'unknown' for c in cities], dtype=bool)
+    has_key, matched, name_pop = index.name_matches(countries, cities, lats, lons, dist_threshold)
+    has_key &= ~unknown
+    near_pop = index.nearest_populated(lats, lons, dist_threshold)
+    return np.where(has_key,
+                    np.where(matched, name_pop, np.where(near_pop > 0, near_pop, -2)),
+                    near_pop)
+
+
+def file_hash(fn, block_size=1 << 24):
+    """Content hash of a (large) file."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(fn, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def geonames_index_dir(geonames_tsv):
+    return os.path.splitext(geonames_tsv)[0] + "_index"
+
+
+def save_geonames_index(index, index_dir, meta):
+    """Write the index arrays as .npy files plus a meta.json describing the source file."""
+    arrays = {'lat': index.lat,
+              'lon': index.lon,
+              'population': index.population,
+              'key_hashes': index.keys.hashes,
+              'key_str_offsets': index.keys.offsets,
+              'key_blob': index.keys.blob,
+              'key_offsets': index.key_offsets,
+              'key_places': index.key_places}
+    # write to a temporary directory and swap so readers never see a partial artifact
+    tmp_dir = index_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), values)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as fout:
+        json.dump(meta, fout)
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir)
+    os.rename(tmp_dir, index_dir)
+
+
+def _read_meta(index_dir):
+    meta_fn = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(meta_fn):
+        return None
+    with open(meta_fn, 'r') as fin:
+        return json.load(fin)
+
+
+def load_geonames_index(geonames_tsv):
+    """Memory-map the compiled Geonames index, rebuilding it if it is missing or stale.
+
+    The artifact is keyed by the source file's size, mtime and content hash: if only the mtime
+    changed (e.g., the same file was copied again) the hash is checked before rebuilding.
+    The content hash is kept as `index.build_id`.
+    """
+    index_dir = geonames_index_dir(geonames_tsv)
+    stat = os.stat(geonames_tsv)
+    meta = _read_meta(index_dir)
+    fresh = (meta is not None and meta['version'] == GEONAMES_INDEX_VERSION and meta['size'] == stat.st_size)
+    if fresh and meta['mtime'] != stat.st_mtime:
+        print("Geonames file modified; checking content hash.")
+        fresh = meta['hash'] == file_hash(geonames_tsv)
+        if fresh:
+            meta['mtime'] = stat.st_mtime
+            with open(os.path.join(index_dir, "meta.json"), 'w') as fout:
+                json.dump(meta, fout)
+    if not fresh:
+        print("Building Geonames index at {0}".format(index_dir))
+        meta = {'version': GEONAMES_INDEX_VERSION,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'hash': file_hash(geonames_tsv)}
+        save_geonames_index(build_geonames_index(get_geonames_map(geonames_tsv)), index_dir, meta)
+    arrays = {name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode='r') for name in INDEX_ARRAYS}
+    index = GeonamesIndex(lat=arrays['lat'], lon=arrays['lon'], population=arrays['population'],
+                          keys=PackedStringIndex(arrays['key_hashes'], arrays['key_str_offsets'], arrays['key_blob']),
+                          key_offsets=arrays['key_offsets'], key_places=arrays['key_places'], build_id=meta['hash'])
+    return index
+
+
+def population_cache_fn(geonames_tsv, build_id, dist_threshold):
+    """Cache of resolved location keys for one Geonames build and distance threshold."""
+    return "{0}_popcache_{1}_{2:g}km.p".format(os.path.splitext(geonames_tsv)[0], build_id, float(dist_threshold))
+
+
+def lookup_populations_cached(index, df, dist_threshold, cache_fn, key_cols=('country_code', 'city', 'lat', 'lon')):
+    """Resolve populations for the distinct location keys of df only, reusing and extending an on-disk cache.
+
+    Returns a population Series aligned with df's index.
+    """
+    key_cols = list(key_cols)
+    keys = pd.DataFrame({'country_code': df[key_cols[0]].fillna('').astype(str).values,
+                         'city': df[key_cols[1]].fillna('').astype(str).values,
+                         'lat': pd.to_numeric(df[key_cols[2]], errors='coerce').values,
+                         'lon': pd.to_numeric(df[key_cols[3]], errors='coerce').values})
+    unique_keys = keys.drop_duplicates()
+    if os.path.exists(cache_fn):
+        cache = pd.read_pickle(cache_fn)
+    else:
+        cache = pd.DataFrame(columns=['country_code', 'city', 'lat', 'lon', 'population'])
+    unique_keys = unique_keys.merge(cache, how='left', on=['country_code', 'city', 'lat', 'lon'])
+    missing = unique_keys['population'].isnull()
+    print("{0} requests; {1} distinct locations; {2} not in cache.".format(len(df), len(unique_keys), missing.sum()))
+    if missing.any():
+        new = unique_keys[missing].copy()
+        new['population'] = lookup_populations(index, new['country_code'].values, new['city'].values,
+                                               new['lat'].values, new['lon'].values, dist_threshold)
+        cache = pd.concat([cache, new], ignore_index=True)
+        cache['population'] = cache['population'].astype(np.int64)
+        cache.to_pickle(cache_fn)
+        unique_keys.loc[missing, 'population'] = new['population'].values
+    populations = keys.merge(unique_keys, how='left', on=['country_code', 'city', 'lat', 'lon'])['population']
+    return pd.Series(populations.astype(np.int64).values, index=df.index)
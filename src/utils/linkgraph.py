@@ -0,0 +1,249 @@
+"""Article link graph features (pagerank, indegree, outdegree) computed from the MediaWiki SQL dumps.
+
+Nodes are the non-redirect namespace-0 pages of page.sql.gz. Links from pagelinks.sql.gz between
+namespace-0 pages are resolved through redirect.sql.gz; self-links are dropped and duplicate links
+(e.g., to a page and to one of its redirects) are collapsed. Newer dumps store link targets in
+linktarget.sql.gz (pl_target_id) instead of pl_namespace / pl_title; both layouts are supported.
+
+Memory stays bounded by a few arrays per page plus one chunk of links:
+ * titles are looked up through sorted 64-bit hashes instead of a dict of strings
+ * links are mapped to node indices chunk by chunk and spilled to disk
+ * the CSR adjacency matrix is assembled from the spilled chunks into a memory-mapped int32 array
+ * PageRank is a power iteration over row blocks of that matrix
+"""
+from array import array
+import itertools
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from .packed import string_hash
+from .redirects import MAX_REDIRECT_HOPS
+from .sqldump import iter_sql_rows
+from .sqldump import sql_columns
+
+DAMPING = 0.85
+PAGERANK_TOL = 1e-6
+PAGERANK_MAX_ITER = 100
+
+
+def hash_titles(titles):
+    return np.fromiter((string_hash(t) for t in titles), dtype=np.uint64, count=len(titles))
+
+
+def iter_chunks(rows, chunk_size):
+    """Group rows into lists of (at most) chunk_size rows."""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class KeyLookup:
+    """Vectorized lookup of integer keys (page ids, title hashes, ...) in sorted arrays."""
+
+    def __init__(self, keys, values):
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.values = values[order]
+
+    @classmethod
+    def from_sorted(cls, keys, values):
+        """Wrap arrays that are already sorted by key (e.g., memory-mapped ones) without copying."""
+        lookup = cls.__new__(cls)
+        lookup.keys = keys
+        lookup.values = values
+        return lookup
+
+    def lookup(self, keys):
+        """Value for each key (-1 if absent)."""
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=self.values.dtype)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, self.values[pos], -1)
+
+
+def read_pages(page_fn):
+    """Page ids, title hashes and redirect flags of all namespace-0 pages."""
+    page_ids = array('q')
+    hashes = array('Q')
+    redirect = array('b')
+    for page_id, namespace, title, is_redirect in iter_sql_rows(
+            page_fn, 'page', ('page_id', 'page_namespace', 'page_title', 'page_is_redirect')):
+        if namespace == 0:
+            page_ids.append(page_id)
+            hashes.append(string_hash(title))
+            redirect.append(is_redirect)
+    return (np.frombuffer(page_ids, dtype=np.int64), np.frombuffer(hashes, dtype=np.uint64),
+            np.frombuffer(redirect, dtype=np.int8).astype(bool))
+
+
+def build_title_nodes(page_fn, redirect_fn, chunk_size=1000000):
+    """Node page ids (sorted) and a lookup from title hash to node index (redirects resolved)."""
+    page_ids, hashes, redirect = read_pages(page_fn)
+    nodes = np.sort(page_ids[~redirect])
+    node_of_page = np.full(len(page_ids), -1, dtype=np.int64)
+    node_of_page[~redirect] = np.searchsorted(nodes, page_ids[~redirect])
+    row_of_title = KeyLookup(hashes, np.arange(len(page_ids)))
+    row_of_page = KeyLookup(page_ids, np.arange(len(page_ids)))
+
+    # redirect page row -> row of its target page
+    target_row = np.full(len(page_ids), -1, dtype=np.int64)
+    for chunk in iter_chunks(iter_sql_rows(redirect_fn, 'redirect', ('rd_from', 'rd_namespace', 'rd_title')),
+                             chunk_size):
+        rd_from, rd_namespace, rd_title = zip(*chunk)
+        in_main = np.array(rd_namespace) == 0
+        sources = row_of_page.lookup(np.array(rd_from, dtype=np.int64)[in_main])
+        targets = row_of_title.lookup(hash_titles([t for t, m in zip(rd_title, in_main) if m]))
+        valid = (sources >= 0) & (targets >= 0)
+        target_row[sources[valid]] = targets[valid]
+
+    # follow (chains of) redirects to a node
+    resolved = node_of_page.copy()
+    current = target_row.copy()
+    for _ in range(MAX_REDIRECT_HOPS):
+        pending = np.flatnonzero((resolved < 0) & (current >= 0))
+        if not len(pending):
+            break
+        resolved[pending] = node_of_page[current[pending]]
+        current[pending] = target_row[current[pending]]
+    print("{0} nodes; {1} of {2} redirects resolved.".format(
+        len(nodes), int((resolved[redirect] >= 0).sum()), int(redirect.sum())))
+    return nodes, KeyLookup(hashes, resolved)
+
+
+def iter_link_chunks(pagelinks_fn, linktarget_fn, nodes, title_nodes, chunk_size):
+    """(source, target) node indices for each chunk of pagelinks rows (-1 where not a node)."""
+    node_of_page = KeyLookup(nodes, np.arange(len(nodes)))
+    if 'pl_target_id' in sql_columns(pagelinks_fn, 'pagelinks'):
+        # link target id -> node index (namespace 0 targets only)
+        lt_ids = array('q')
+        lt_nodes = []
+        for chunk in iter_chunks(iter_sql_rows(linktarget_fn, 'linktarget', ('lt_id', 'lt_namespace', 'lt_title')),
+                                 chunk_size):
+            chunk = [r for r in chunk if r[1] == 0]
+            lt_ids.extend(r[0] for r in chunk)
+            lt_nodes.append(title_nodes.lookup(hash_titles([r[2] for r in chunk])))
+        target_nodes = KeyLookup(np.frombuffer(lt_ids, dtype=np.int64), np.concatenate(lt_nodes or [np.zeros(0, np.int64)]))
+        rows = iter_sql_rows(pagelinks_fn, 'pagelinks', ('pl_from', 'pl_from_namespace', 'pl_target_id'))
+        for chunk in iter_chunks(rows, chunk_size):
+            pl_from, from_namespace, target_id = (np.array(c, dtype=np.int64) for c in zip(*chunk))
+            sources = np.where(from_namespace == 0, node_of_page.lookup(pl_from), -1)
+            yield sources, target_nodes.lookup(target_id)
+    else:
+        rows = iter_sql_rows(pagelinks_fn, 'pagelinks', ('pl_from', 'pl_from_namespace', 'pl_namespace', 'pl_title'))
+        for chunk in iter_chunks(rows, chunk_size):
+            chunk = [r for r in chunk if r[1] == 0 and r[2] == 0]
+            if not chunk:
+                continue
+            pl_from = np.array([r[0] for r in chunk], dtype=np.int64)
+            yield node_of_page.lookup(pl_from), title_nodes.lookup(hash_titles([r[3] for r in chunk]))
+
+
+def build_link_matrix(link_chunks, num_nodes, work_dir):
+    """Assemble the CSR adjacency matrix (rows: linking page) from chunks of (source, target) node indices.
+
+    Returns (indptr, indices, indegree, outdegree); indices is an int32 array memory-mapped from work_dir.
+    Duplicates are removed per chunk; the links of the last source of a chunk are carried over to the
+    next chunk so that pages are never split (the dumps are ordered by pl_from).
+    """
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    indegree = np.zeros(num_nodes, dtype=np.int64)
+    outdegree = np.zeros(num_nodes, dtype=np.int64)
+    num_chunks = 0
+    carry = np.zeros(0, dtype=np.int64)
+
+    def spill(keys):
+        keys = np.unique(keys)
+        np.save(os.path.join(work_dir, "edges_{0:06d}.npy".format(num_chunks)), keys)
+        outdegree[:] += np.bincount(keys >> 32, minlength=num_nodes)
+        indegree[:] += np.bincount(keys & 0xffffffff, minlength=num_nodes)
+
+    for sources, targets in link_chunks:
+        valid = (sources >= 0) & (targets >= 0) & (sources != targets)
+        keys = np.concatenate([carry, (sources[valid] << 32) | targets[valid]])
+        if not len(keys):
+            continue
+        last = (keys >> 32) == (keys[-1] >> 32)
+        carry = keys[last]
+        if not last.all():
+            spill(keys[~last])
+            num_chunks += 1
+    if len(carry):
+        spill(carry)
+        num_chunks += 1
+
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(outdegree, out=indptr[1:])
+    indices = np.lib.format.open_memmap(os.path.join(work_dir, "indices.npy"), mode='w+',
+                                        dtype=np.int32, shape=(int(indptr[-1]),))
+    next_free = indptr[:-1].copy()
+    for i in range(num_chunks):
+        chunk_fn = os.path.join(work_dir, "edges_{0:06d}.npy".format(i))
+        keys = np.load(chunk_fn)
+        os.remove(chunk_fn)
+        sources = keys >> 32
+        # keys are sorted, so the links of each source are consecutive
+        starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]])
+        counts = np.diff(np.r_[starts, len(keys)])
+        rank = np.arange(len(keys)) - np.repeat(starts, counts)
+        indices[next_free[sources] + rank] = (keys & 0xffffffff).astype(np.int32)
+        next_free[sources[starts]] += counts
+    indices.flush()
+    print("{0} links between {1} pages.".format(len(indices), num_nodes))
+    return indptr, indices, indegree, outdegree
+
+
+def pagerank(indptr, indices, outdegree, damping=DAMPING, tol=PAGERANK_TOL, max_iter=PAGERANK_MAX_ITER,
+             block_links=1 << 26):
+    """PageRank by power iteration (rank of dangling pages is spread uniformly).
+
+    Stops once the L1 change is below num_nodes * tol (as in networkx) or after max_iter iterations.
+    The matrix is traversed in row blocks of about `block_links` links.
+    """
+    num_nodes = len(outdegree)
+    if not num_nodes:
+        return np.zeros(0)
+    blocks = np.unique(np.r_[np.searchsorted(indptr, np.arange(0, indptr[-1], block_links), side='right') - 1,
+                             num_nodes])
+    dangling = outdegree == 0
+    rank = np.full(num_nodes, 1. / num_nodes)
+    for i in range(max_iter):
+        share = np.where(dangling, 0., rank / np.maximum(outdegree, 1))
+        new_rank = np.zeros(num_nodes)
+        for start, stop in zip(blocks[:-1], blocks[1:]):
+            new_rank += np.bincount(indices[indptr[start]:indptr[stop]],
+                                    weights=np.repeat(share[start:stop], outdegree[start:stop]),
+                                    minlength=num_nodes)
+        new_rank = damping * (new_rank + rank[dangling].sum() / num_nodes) + (1 - damping) / num_nodes
+        err = np.abs(new_rank - rank).sum()
+        rank = new_rank
+        if err < num_nodes * tol:
+            print("PageRank converged after {0} iterations.".format(i + 1))
+            return rank
+    print("PageRank did not converge within {0} iterations (L1 change {1}).".format(max_iter, err))
+    return rank
+
+
+def build_graph_features(page_fn, redirect_fn, pagelinks_fn, linktarget_fn, output_fn, work_dir,
+                         chunk_size=1000000):
+    """Write `page_id, pagerank, indegree, outdegree` (no header) for every article to output_fn.
+
+    Links are parsed as lists of Python rows, chunk_size rows at a time (~200 bytes per row), so
+    chunk_size bounds the memory on top of the per-page arrays.
+    """
+    nodes, title_nodes = build_title_nodes(page_fn, redirect_fn)
+    link_chunks = iter_link_chunks(pagelinks_fn, linktarget_fn, nodes, title_nodes, chunk_size)
+    indptr, indices, indegree, outdegree = build_link_matrix(link_chunks, len(nodes), work_dir)
+    ranks = pagerank(indptr, indices, outdegree)
+    pd.DataFrame({'id': nodes, 'pagerank': ranks, 'indegree': indegree, 'outdegree': outdegree}).to_csv(
+        output_fn, header=False, index=False)
+    del indices
+    shutil.rmtree(work_dir)
+    return output_fn
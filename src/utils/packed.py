@@ -0,0 +1,66 @@
+"""Hashed, packed string tables that can be saved as .npy arrays and memory-mapped."""
+import hashlib
+
+import numpy as np
+
+
+def string_hash(s):
+    """Stable 64-bit hash of a string (Python's hash() is salted per process)."""
+    return int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def pack_strings(strings):
+    """Concatenate strings as UTF-8 into one byte blob; returns (offsets, blob)."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+
+def unpack_string(offsets, blob, i):
+    return bytes(blob[offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+
+class PackedStringIndex:
+    """Sorted string hashes plus the strings themselves (to rule out hash collisions).
+
+    `find` maps strings to their position in hash order, so other arrays stored
+    in the same order can be used as values.
+    """
+
+    def __init__(self, hashes, offsets, blob):
+        self.hashes = hashes
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def build(cls, strings):
+        """Build from unique strings. Returns (index, order) where order[i] is the input position of entry i."""
+        hashes = np.array([string_hash(s) for s in strings], dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        offsets, blob = pack_strings([strings[i] for i in order])
+        return cls(hashes[order], offsets, blob), order
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def string(self, i):
+        return unpack_string(self.offsets, self.blob, i)
+
+    def find(self, strings):
+        """Position of each string in the index (-1 if absent)."""
+        strings = list(strings)
+        positions = np.full(len(strings), -1, dtype=np.int64)
+        if not strings or not len(self.hashes):
+            return positions
+        queries = np.array([string_hash(s) for s in strings], dtype=np.uint64)
+        lo = np.searchsorted(self.hashes, queries, side='left')
+        hi = np.searchsorted(self.hashes, queries, side='right')
+        for q in np.flatnonzero(hi > lo):
+            # almost always a single candidate; compare strings to rule out hash collisions
+            for i in range(lo[q], hi[q]):
+                if self.string(i) == strings[q]:
+                    positions[q] = i
+                    break
+        return positions
@@ -0,0 +1,107 @@
+"""Weekly pageviews per article from locally stored pageview dumps (no Hive needed).
+
+Expects the daily "pageview complete" dumps split by agent type
+(https://dumps.wikimedia.org/other/pageview_complete/), and only their `user` variant
+`pageviews-YYYYMMDD-user.bz2`: like the Hive query on wmf.pageview_hourly (agent_type = 'user'),
+spiders and automated traffic are left out. The older hourly files in other/pageviews/ mix all agent
+types and must not be used. Lines are
+`wiki_code page_title page_id access_method daily_total hourly_counts`, e.g.
+`en.wikipedia Barack_Obama 534366 mobile-web 5203 A212B180...`, where hourly_counts pairs an hour
+letter (A = 00:00 UTC ... X = 23:00) with the views of that hour, so that only the hours of the survey
+period are counted.
+Titles of the project (all access methods) are mapped to page ids with the namespace-0 title lookup
+of the page / redirect SQL dumps (views of a redirect count for its target, which also drops other
+namespaces) and summed in an integer array per page.
+Days are processed in parallel; the title lookup is shared with the workers through
+memory-mapped .npy files.
+"""
+import bz2
+import datetime
+from multiprocessing import Pool
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from .linkgraph import hash_titles
+from .linkgraph import KeyLookup
+
+HOUR_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWX"
+_hourly_count = re.compile(r"([A-X])(\d+)")
+
+_worker_lookup = None
+
+
+def user_pageview_files(dump_dir, start, end):
+    """Expected pageviews-YYYYMMDD-user.bz2 file and the hour letters in [start, end) for every day."""
+    files = []
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour < end:
+        fn = os.path.join(dump_dir, "pageviews-{0}-user.bz2".format(hour.strftime("%Y%m%d")))
+        if not files or files[-1][0] != fn:
+            files.append((fn, ""))
+        files[-1] = (fn, files[-1][1] + HOUR_LETTERS[hour.hour])
+        hour += datetime.timedelta(hours=1)
+    return files
+
+
+def _init_worker(lookup_dir):
+    global _worker_lookup
+    _worker_lookup = KeyLookup.from_sorted(np.load(os.path.join(lookup_dir, "keys.npy"), mmap_mode='r'),
+                                           np.load(os.path.join(lookup_dir, "values.npy"), mmap_mode='r'))
+
+
+def count_day(fn, wiki_code, hours):
+    """Views per node in one daily file, counting only the given hour letters, as (node indices, views)."""
+    titles = []
+    views = []
+    whole_day = len(hours) == len(HOUR_LETTERS)
+    with bz2.open(fn, 'rt', encoding='utf-8', errors='replace') as fin:
+        for line in fin:
+            tokens = line.rstrip('\n').split(' ')
+            if len(tokens) < 6 or tokens[0] != wiki_code:
+                continue
+            if whole_day:
+                count = int(tokens[4])
+            else:
+                count = sum(int(n) for h, n in _hourly_count.findall(tokens[5]) if h in hours)
+            if count:
+                titles.append(tokens[1])
+                views.append(count)
+    nodes = _worker_lookup.lookup(hash_titles(titles))
+    views = np.array(views, dtype=np.int64)
+    found = nodes >= 0
+    node_ids, inverse = np.unique(nodes[found], return_inverse=True)
+    return node_ids, np.bincount(inverse, weights=views[found]).astype(np.int64)
+
+
+def aggregate_pageviews(lang, daily_files, nodes, title_nodes, output_fn, work_dir, workers=1):
+    """Sum views over the (file, hours) of user_pageview_files and write `page_id<TAB>weekly_pageviews` (with header) to output_fn."""
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    np.save(os.path.join(work_dir, "keys.npy"), title_nodes.keys)
+    np.save(os.path.join(work_dir, "values.npy"), title_nodes.values)
+    missing = [fn for fn, _ in daily_files if not os.path.exists(fn)]
+    if missing:
+        print("{0} of {1} daily files missing, e.g. {2}".format(len(missing), len(daily_files), missing[0]))
+    daily_files = [(fn, hours) for fn, hours in daily_files if os.path.exists(fn)]
+    args = [(fn, lang + ".wikipedia", hours) for fn, hours in daily_files]
+    totals = np.zeros(len(nodes), dtype=np.int64)
+    if workers > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(work_dir,)) as pool:
+            for node_ids, views in pool.starmap(count_day, args):
+                totals[node_ids] += views
+    else:
+        _init_worker(work_dir)
+        for a in args:
+            node_ids, views = count_day(*a)
+            totals[node_ids] += views
+    shutil.rmtree(work_dir)
+    viewed = totals > 0
+    pd.DataFrame({'page_id': nodes[viewed], 'weekly_pageviews': totals[viewed]}).to_csv(
+        output_fn, sep="\t", index=False)
+    print("{0} pages with views in {1} daily files.".format(int(viewed.sum()), len(daily_files)))
+    return output_fn
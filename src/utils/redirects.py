@@ -0,0 +1,147 @@
+"""Compact, memory-mapped redirect index built from `{lang}_redirect.tsv`.
+
+The index is a directory of .npy arrays:
+ * hashes: sorted uint64 hashes of the redirect sources
+ * src_offsets / src_blob: the UTF-8 source titles in hash order (to rule out hash collisions)
+ * target_ids: index of the (deduplicated) target title for each source
+ * tgt_offsets / tgt_blob: the UTF-8 target titles
+Redirect chains (A -> B -> C) are resolved when the index is built so every source maps to its
+final target. Arrays are opened with mmap so loading is near-instant and processes share pages.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .packed import pack_strings
+from .packed import PackedStringIndex
+from .packed import unpack_string
+
+INDEX_VERSION = 1
+MAX_REDIRECT_HOPS = 10
+INDEX_ARRAYS = ('hashes', 'src_offsets', 'src_blob', 'target_ids', 'tgt_offsets', 'tgt_blob')
+
+
+def iter_redirects(redirect_fn):
+    """Yield (source, target) pairs from a redirect TSV, stripping surrounding quotes."""
+    with open(redirect_fn, "r") as f:
+        for line in f:
+            tokens = line.split("\t")
+            source = tokens[0].strip()
+            if source.startswith('"') and source.endswith('"'):
+                source = source[1:-1]
+            target = tokens[1].strip()
+            if target.startswith('"') and target.endswith('"'):
+                target = target[1:-1]
+            yield source, target
+
+
+def resolve_chains(redirects, max_hops=MAX_REDIRECT_HOPS):
+    """Map every source to the end of its redirect chain (cycles stop before revisiting a title)."""
+    resolved = {}
+    for source, target in redirects.items():
+        seen = {source, target}
+        hops = 1
+        while target in redirects and redirects[target] not in seen and hops < max_hops:
+            target = redirects[target]
+            seen.add(target)
+            hops += 1
+        resolved[source] = target
+    return resolved
+
+
+def _index_dir(lang, redirect_dir):
+    return os.path.join(redirect_dir, "{0}_redirect_index".format(lang))
+
+
+def _source_meta(redirect_fn):
+    stat = os.stat(redirect_fn)
+    return {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def build_redirect_index(lang, redirect_dir):
+    """Compile {lang}_redirect.tsv into the on-disk index. Returns the index directory."""
+    redirect_fn = os.path.join(redirect_dir, "{0}_redirect.tsv".format(lang))
+    index_dir = _index_dir(lang, redirect_dir)
+    print("Building redirect index at {0}".format(index_dir))
+    resolved = resolve_chains(dict(iter_redirects(redirect_fn)))
+    sources = list(resolved)
+    source_index, order = PackedStringIndex.build(sources)
+    sources = [sources[i] for i in order]
+    targets = sorted(set(resolved.values()))
+    target_lookup = {t: i for i, t in enumerate(targets)}
+    tgt_offsets, tgt_blob = pack_strings(targets)
+    arrays = {'hashes': source_index.hashes,
+              'src_offsets': source_index.offsets,
+              'src_blob': source_index.blob,
+              'target_ids': np.array([target_lookup[resolved[s]] for s in sources], dtype=np.int32),
+              'tgt_offsets': tgt_offsets,
+              'tgt_blob': tgt_blob}
+
+    # write to a temporary directory and swap so readers never see a partial index
+    tmp_dir = index_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), values)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as fout:
+        json.dump(_source_meta(redirect_fn), fout)
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir)
+    os.rename(tmp_dir, index_dir)
+    print("{0} redirects indexed ({1} distinct targets).".format(len(sources), len(targets)))
+    return index_dir
+
+
+def load_redirect_index(lang, redirect_dir):
+    """Memory-map the redirect index for a language, (re)building it if missing or stale."""
+    redirect_fn = os.path.join(redirect_dir, "{0}_redirect.tsv".format(lang))
+    index_dir = _index_dir(lang, redirect_dir)
+    if not os.path.exists(redirect_fn):
+        print("{0} does not exist. No redirects taken into consideration.".format(redirect_fn))
+        return RedirectIndex.empty()
+    meta_fn = os.path.join(index_dir, "meta.json")
+    stale = True
+    if os.path.exists(meta_fn):
+        with open(meta_fn, 'r') as fin:
+            stale = json.load(fin) != _source_meta(redirect_fn)
+    if stale:
+        build_redirect_index(lang, redirect_dir)
+    return RedirectIndex({name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode='r')
+                          for name in INDEX_ARRAYS})
+
+
+class RedirectIndex:
+    """Read-only source title -> final target title lookup over the compiled arrays."""
+
+    def __init__(self, arrays):
+        self.sources = PackedStringIndex(arrays['hashes'], arrays['src_offsets'], arrays['src_blob'])
+        self.target_ids = arrays['target_ids']
+        self.tgt_offsets = arrays['tgt_offsets']
+        self.tgt_blob = arrays['tgt_blob']
+
+    @classmethod
+    def empty(cls):
+        return cls({'hashes': np.zeros(0, dtype=np.uint64),
+                    'src_offsets': np.zeros(1, dtype=np.int64),
+                    'src_blob': np.zeros(0, dtype=np.uint8),
+                    'target_ids': np.zeros(0, dtype=np.int32),
+                    'tgt_offsets': np.zeros(1, dtype=np.int64),
+                    'tgt_blob': np.zeros(0, dtype=np.uint8)})
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __contains__(self, title):
+        return self.get(title) is not None
+
+    def get(self, title, default=None):
+        target = self.lookup([title])[0]
+        return default if target is None else target
+
+    def lookup(self, titles):
+        """Batched lookup: final redirect target for each title (None if not a redirect)."""
+        return [None if i < 0 else unpack_string(self.tgt_offsets, self.tgt_blob, self.target_ids[i])
+                for i in self.sources.find(titles)]
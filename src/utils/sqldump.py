@@ -0,0 +1,79 @@
+"""Streaming reader for MediaWiki SQL table dumps (page.sql.gz, pagelinks.sql.gz, redirect.sql.gz, ...).
+
+The dumps consist of a CREATE TABLE statement followed by long `INSERT INTO ... VALUES (...),(...);`
+lines. Rows are matched and split with regular expressions (so the work per row happens in C) and
+only the requested columns are converted to Python values: strings are unescaped, NULL becomes None
+and numbers become int (or float).
+"""
+import gzip
+import re
+
+_ROW = re.compile(r"\(((?:'(?:[^'\\]|\\.)*'|[^'()])*)\)", re.S)
+_VALUE = re.compile(r"'(?:[^'\\]|\\.)*'|[^,']+", re.S)
+_ESCAPE = re.compile(r"\\(.)", re.S)
+_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+_COLUMN = re.compile(r"^\s*`(\w+)`")
+
+
+def parse_sql_value(token):
+    if token.startswith("'"):
+        return _ESCAPE.sub(lambda m: _ESCAPES.get(m.group(1), m.group(1)), token[1:-1])
+    if token == 'NULL':
+        return None
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+def sql_columns(dump_fn, table):
+    """Column names of `table` from the CREATE TABLE statement at the top of a (gzipped) SQL dump."""
+    create_prefix = "CREATE TABLE `{0}` (".format(table)
+    names = []
+    in_create = False
+    with gzip.open(dump_fn, 'rt', encoding='utf-8', errors='replace') as fin:
+        for line in fin:
+            if in_create:
+                column = _COLUMN.match(line)
+                if column:
+                    names.append(column.group(1))
+                elif line.startswith(")"):
+                    break
+            elif line.startswith(create_prefix):
+                in_create = True
+            elif line.startswith("INSERT INTO"):
+                break
+    return names
+
+
+def iter_sql_rows(dump_fn, table, columns=None):
+    """Yield the rows of `table` in a (gzipped) SQL dump as lists of values.
+
+    `columns` selects (and orders) columns by name as given in the CREATE TABLE statement,
+    so the same code works across MediaWiki versions with different table layouts.
+    """
+    insert_prefix = "INSERT INTO `{0}` VALUES ".format(table)
+    create_prefix = "CREATE TABLE `{0}` (".format(table)
+    names = []
+    in_create = False
+    positions = None
+    with gzip.open(dump_fn, 'rt', encoding='utf-8', errors='replace') as fin:
+        for line in fin:
+            if line.startswith(insert_prefix):
+                if positions is None and columns is not None:
+                    positions = [names.index(c) for c in columns]
+                for row in _ROW.finditer(line, len(insert_prefix)):
+                    values = _VALUE.findall(row.group(1))
+                    if positions is None:
+                        yield [parse_sql_value(v) for v in values]
+                    else:
+                        yield [parse_sql_value(values[i]) for i in positions]
+            elif in_create:
+                column = _COLUMN.match(line)
+                if column:
+                    names.append(column.group(1))
+                elif line.startswith(")"):
+                    in_create = False
+            elif line.startswith(create_prefix):
+                in_create = True
+                names = []
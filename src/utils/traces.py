@@ -0,0 +1,372 @@
+"""Columnar (struct-of-arrays) representation of webrequest traces.
+
+Traces come out of Hive as one line per user with every request encoded as
+`name|value|name|value...` and requests joined by `config.request_delim`.
+Rather than turning each request into its own dict, all requests of all users
+are stored in one TraceTable: per-user offsets plus one typed NumPy array per field.
+String fields are dictionary-encoded (int32 codes into a small vocabulary) so that
+comparisons such as `referer_class == 'internal'` are integer operations.
+"""
+from array import array
+import datetime
+
+import numpy as np
+
+from . import config
+
+# fields kept from the pipe-encoded requests (referer / uri_query are dropped)
+STRING_FIELDS = ('title', 'uri_path', 'referer_class', 'access_method', 'lang', 'uri_host', 'is_pageview')
+TRACE_FIELDS = ('ts', 'page_id') + STRING_FIELDS
+
+# code for missing string values (e.g., request had no title)
+MISSING = -1
+
+
+class TraceTable:
+    """Request traces of many users stored as columns.
+
+    Requests of user `u` are rows `offsets[u]:offsets[u + 1]`, sorted by time.
+    Columns:
+     * ts: datetime64[s]
+     * page_id: int64 (-1 if missing / not an integer)
+     * id: int32 position of the request within the user's trace
+     * STRING_FIELDS: int32 codes into `vocabs[field]` (MISSING if not present)
+    """
+
+    def __init__(self, offsets, columns, vocabs):
+        self.offsets = offsets
+        self.columns = columns
+        self.vocabs = vocabs
+        self._code_lookup = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        return {'offsets': self.offsets, 'columns': self.columns, 'vocabs': self.vocabs}
+
+    def __setstate__(self, state):
+        self.__init__(state['offsets'], state['columns'], state['vocabs'])
+
+    @property
+    def num_requests(self):
+        return int(self.offsets[-1])
+
+    def lengths(self):
+        """Number of requests for each user."""
+        return np.diff(self.offsets)
+
+    def epoch_seconds(self, rows=slice(None)):
+        """Request timestamps as int64 seconds since the epoch (UTC)."""
+        return self.columns['ts'][rows].astype(np.int64)
+
+    def num_invalid_ts(self):
+        """Number of requests whose timestamp could not be parsed (NaT)."""
+        return int(np.isnat(self.columns['ts']).sum())
+
+    def user_index(self):
+        """User index (into this table) for every request."""
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.lengths())
+
+    def trace(self, user):
+        return Trace(self, slice(int(self.offsets[user]), int(self.offsets[user + 1])))
+
+    def traces(self):
+        return [self.trace(u) for u in range(len(self))]
+
+    def code(self, field, value):
+        """Integer code for `value` in string field (-2 if value never occurs so it matches nothing)."""
+        if field not in self._code_lookup:
+            self._code_lookup[field] = {v: i for i, v in enumerate(self.vocabs[field])}
+        return self._code_lookup[field].get(value, -2)
+
+    def column(self, field, rows=slice(None)):
+        """Decoded values of a field (strings for dictionary-encoded fields, None if missing)."""
+        values = self.columns[field][rows]
+        if field not in self.vocabs:
+            return values
+        missing = values == MISSING
+        decoded = np.empty(len(values), dtype=object)
+        decoded[~missing] = self.vocabs[field][values[~missing]]
+        return decoded
+
+    def equals(self, field, value, rows=slice(None)):
+        """Boolean mask of requests in `rows` whose field is equal to value."""
+        if field in self.vocabs:
+            return self.columns[field][rows] == self.code(field, value)
+        return self.columns[field][rows] == value
+
+    def record(self, row):
+        """Single request as a dict, in the same shape as the old parse_requests output."""
+        r = {}
+        for field, values in self.columns.items():
+            v = values[row]
+            if field in self.vocabs:
+                if v == MISSING:
+                    continue
+                r[field] = self.vocabs[field][v]
+            elif field == 'ts':
+                r[field] = v.astype(datetime.datetime)
+            else:
+                r[field] = int(v)
+        return r
+
+    def map_strings(self, field, mapping, rows_mask=None):
+        """Replace values of a string field according to `mapping` (dict or RedirectIndex).
+
+        The mapping is applied once per distinct value rather than once per request.
+        If `rows_mask` is given, only those requests are updated.
+        """
+        vocab = list(self.vocabs[field])
+        if isinstance(mapping, dict):
+            targets = [mapping.get(v) for v in vocab]
+        else:
+            # e.g., RedirectIndex: one batched lookup for the whole vocabulary
+            targets = mapping.lookup(vocab)
+        lookup = {v: i for i, v in enumerate(vocab)}
+        remap = np.arange(len(vocab) + 1, dtype=np.int32)
+        remap[-1] = MISSING
+        for i in range(len(remap) - 1):
+            target = targets[i]
+            if target is not None and target != vocab[i]:
+                code = lookup.get(target)
+                if code is None:
+                    code = lookup[target] = len(vocab)
+                    vocab.append(target)
+                remap[i] = code
+        codes = self.columns[field]
+        new_codes = remap[codes]
+        if rows_mask is not None:
+            new_codes = np.where(rows_mask, new_codes, codes)
+        self.columns[field] = new_codes
+        self.vocabs[field] = np.array(vocab, dtype=object)
+        self._code_lookup.pop(field, None)
+
+    def take(self, row_groups):
+        """New compact table holding only `row_groups` (one slice or index array per user)."""
+        rows = []
+        lengths = []
+        for g in row_groups:
+            if isinstance(g, slice):
+                g = np.arange(g.start, g.stop, dtype=np.int64)
+            rows.append(g)
+            lengths.append(len(g))
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        columns = {field: values[rows] for field, values in self.columns.items()}
+        return TraceTable(offsets, columns, {f: v for f, v in self.vocabs.items()})
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Stack tables (e.g., parsed from separate chunks of a file) into one, merging vocabularies."""
+        tables = list(tables)
+        if not tables:
+            return TraceTableBuilder().build()
+        lengths = [t.lengths() for t in tables]
+        offsets = np.zeros(sum(len(t) for t in tables) + 1, dtype=np.int64)
+        if lengths:
+            np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        columns = {}
+        vocabs = {}
+        for field in tables[0].columns:
+            if field not in tables[0].vocabs:
+                columns[field] = np.concatenate([t.columns[field] for t in tables])
+                continue
+            vocab = []
+            lookup = {}
+            codes = []
+            for t in tables:
+                remap = np.empty(len(t.vocabs[field]) + 1, dtype=np.int32)
+                remap[-1] = MISSING
+                for i, v in enumerate(t.vocabs[field]):
+                    code = lookup.get(v)
+                    if code is None:
+                        code = lookup[v] = len(vocab)
+                        vocab.append(v)
+                    remap[i] = code
+                codes.append(remap[t.columns[field]])
+            columns[field] = np.concatenate(codes)
+            vocabs[field] = np.array(vocab, dtype=object)
+        return cls(offsets, columns, vocabs)
+
+    @classmethod
+    def from_traces(cls, traces):
+        """Build a compact table from Trace views (e.g., a filtered DataFrame column).
+
+        Traces that are None (no requests) become empty traces.
+        """
+        traces = [t if isinstance(t, Trace) else None for t in traces]
+        tables = {id(t.table): t.table for t in traces if t is not None}
+        if len(tables) == 1:
+            table = next(iter(tables.values()))
+            return table.take([t.rows if t is not None else slice(0, 0) for t in traces])
+        builder = TraceTableBuilder()
+        for t in traces:
+            builder.add_records(list(t) if t is not None else [])
+        return builder.build()
+
+
+class Trace:
+    """View on the requests of one user (or a subset of them, e.g., a session) in a TraceTable.
+
+    Behaves like the old list of request dicts (len, indexing, iteration yield dicts)
+    but feature code should use `column` / `equals` to work on the arrays directly.
+    """
+    __slots__ = ('table', 'rows')
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+
+    def __len__(self):
+        if isinstance(self.rows, slice):
+            return self.rows.stop - self.rows.start
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.table.record(self.row_index()[i])
+
+    def __iter__(self):
+        for row in self.row_index():
+            yield self.table.record(row)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def row_index(self):
+        """Absolute table rows of this trace."""
+        if isinstance(self.rows, slice):
+            return np.arange(self.rows.start, self.rows.stop, dtype=np.int64)
+        return self.rows
+
+    def column(self, field):
+        return self.table.column(field, self.rows)
+
+    def codes(self, field):
+        return self.table.columns[field][self.rows]
+
+    def epoch_seconds(self):
+        return self.table.epoch_seconds(self.rows)
+
+    def equals(self, field, value):
+        return self.table.equals(field, value, self.rows)
+
+    def slice(self, start, stop):
+        """Sub-trace of consecutive requests [start, stop)."""
+        if isinstance(self.rows, slice):
+            return Trace(self.table, slice(self.rows.start + start, self.rows.start + stop))
+        return Trace(self.table, self.rows[start:stop])
+
+    def select(self, mask):
+        """Sub-trace of the requests where mask is True."""
+        return Trace(self.table, self.row_index()[mask])
+
+
+class TraceTableBuilder:
+    """Incrementally parse pipe-encoded request strings into a TraceTable.
+
+    Timestamps are kept as strings and converted to datetime64 in bulk, `ts_batch_size`
+    at a time; timestamps that cannot be parsed become NaT (see TraceTable.num_invalid_ts).
+    """
+
+    def __init__(self, ts_batch_size=1 << 16):
+        self._lengths = array('q')
+        self._ts = []
+        self._pending_ts = []
+        self._ts_batch_size = ts_batch_size
+        self._page_id = array('q')
+        self._id = array('i')
+        self._codes = {f: array('i') for f in STRING_FIELDS}
+        self._vocabs = {f: {} for f in STRING_FIELDS}
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, requests):
+        """Parse one user's `requests` string and append it. Returns the user index or None.
+
+        Mirrors the old parse_requests: malformed requests (odd number of tokens) are skipped
+        and a user is rejected if any of their requests has no timestamp.
+        """
+        records = []
+        for r in requests.split(config.request_delim):
+            t = r.split('|')
+            if (len(t) % 2) != 0:  # should be list of (name, value) pairs and contain at least ts,title
+                continue
+            records.append(dict(zip(t[0::2], t[1::2])))
+        return self.add_records(records)
+
+    def add_records(self, records):
+        """Append one user's requests given as dicts. Returns the user index or None."""
+        try:
+            ts = [r['ts'] for r in records]
+        except KeyError:
+            return None
+        order = sorted(range(len(ts)), key=ts.__getitem__)  # sort by time
+        if ts and not isinstance(ts[0], str):
+            ts = [str(t) for t in ts]
+        self._pending_ts.extend([ts[i] for i in order])
+        if len(self._pending_ts) >= self._ts_batch_size:
+            self._flush_ts()
+        for pos, i in enumerate(order):
+            r = records[i]
+            self._page_id.append(_parse_page_id(r.get('page_id')))
+            self._id.append(pos)
+            for f in STRING_FIELDS:
+                v = r.get(f)
+                if v is None:
+                    self._codes[f].append(MISSING)
+                else:
+                    vocab = self._vocabs[f]
+                    code = vocab.get(v)
+                    if code is None:
+                        code = vocab[v] = len(vocab)
+                    self._codes[f].append(code)
+        self._lengths.append(len(order))
+        return len(self._lengths) - 1
+
+    def _flush_ts(self):
+        self._ts.append(parse_timestamps(self._pending_ts))
+        self._pending_ts = []
+
+    def build(self):
+        self._flush_ts()
+        offsets = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(self._lengths, dtype=np.int64), out=offsets[1:])
+        columns = {'ts': np.concatenate(self._ts),
+                   'page_id': np.frombuffer(self._page_id, dtype=np.int64).copy(),
+                   'id': np.frombuffer(self._id, dtype=np.int32).copy()}
+        vocabs = {}
+        for f in STRING_FIELDS:
+            columns[f] = np.frombuffer(self._codes[f], dtype=np.int32).copy()
+            vocab = np.empty(len(self._vocabs[f]), dtype=object)
+            for v, i in self._vocabs[f].items():
+                vocab[i] = v
+            vocabs[f] = vocab
+        return TraceTable(offsets, columns, vocabs)
+
+
+def parse_timestamps(ts):
+    """Parse 'YYYY-MM-DD HH:MM:SS' strings into a datetime64[s] array in one call.
+
+    Invalid values become NaT instead of raising; callers count them with np.isnat and report them.
+    """
+    try:
+        return np.array(ts, dtype='datetime64[s]')
+    except ValueError:
+        return np.array([_parse_timestamp(t) for t in ts], dtype='datetime64[s]')
+
+
+def _parse_timestamp(ts):
+    try:
+        return np.datetime64(ts, 's')
+    except ValueError:
+        return np.datetime64('NaT')
+
+
+def _parse_page_id(page_id):
+    try:
+        return int(page_id)
+    except (TypeError, ValueError):
+        return -1
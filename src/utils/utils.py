@@ -1,6 +1,8 @@
 import hashlib
 import os
 
+from .redirects import iter_redirects
+
 
 def exec_hive_stat2(query, filename=None, priority=False, verbose=True, nice=False):
     """Query Hive."""
@@ -49,16 +51,8 @@ def read_redirects(lang, redirect_dir):
     redirect_dict = {}
     redirect_fn = os.path.join(redirect_dir, "{0}_redirect.tsv".format(lang))
     if os.path.exists(redirect_fn):
-        with open(redirect_fn, "r") as f:
-            for line in f:
-                tokens = line.split("\t")
-                source = tokens[0].strip()
-                if source.startswith('"') and source.endswith('"'):
-                    source = source[1:-1]
-                target = tokens[1].strip()
-                if target.startswith('"') and target.endswith('"'):
-                    target = target[1:-1]
-                redirect_dict[source] = target
+        for source, target in iter_redirects(redirect_fn):
+            redirect_dict[source] = target
     else:
         print("{0} does not exist. No redirects taken into consideration.".format(redirect_fn))
     return redirect_dict
\ No newline at end of file